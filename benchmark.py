@@ -0,0 +1,360 @@
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import argparse
+from django.conf import settings
+
+
+class EmailTemplateBenchmark(object):
+    """
+    Measures the throughput of template lookup, rendering, text 
+    autogeneration and bulk sending against an in-memory SQLite database and 
+    the locmem email backend, and reports the results as JSON.
+
+    Each benchmark calls its function enough times to take at least MIN_TIME 
+    seconds, repeats that repeat times, and reports the best and median 
+    times, along with the process's peak resident memory (its high-water 
+    mark, which never decreases) once the benchmark has run.
+
+    Example usage:
+
+        >>> EmailTemplateBenchmark(repeat=5).run()
+    """
+    INSTALLED_APPS = (
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sites',
+        'emailtemplates',
+    )
+    TEMPLATE_SIZES = (('small', 1), ('medium', 10), ('large', 100))
+    MIN_TIME = 0.2
+    MASS_MAIL_SIZES = (1000, 10000, 100000)
+    OVERRIDE_ROWS = 100000
+
+    def __init__(self, repeat=5, max_recipients=None, only=None):
+        self.repeat = repeat
+        self.max_recipients = max_recipients
+        self.only = only
+        self.results = []
+        self._configure()
+
+    def _configure(self):
+        settings.configure(
+            DEBUG = False,
+            DATABASES = {
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:',
+                }
+            },
+            INSTALLED_APPS = self.INSTALLED_APPS,
+            EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend',
+            EMAILTEMPLATES_ALLOW_HTML_MESSAGES = True,
+            SITE_ID = 1,
+            USE_TZ = True,
+        )
+        from django.core.management import call_command
+        call_command('syncdb', interactive=False, verbosity=0)
+
+    def run(self):
+        """
+        Run the benchmarks and return a dictionary describing the environment 
+        and the results.
+        """
+        from django.contrib.sites.models import Site
+        from emailtemplates.models import EmailMessageTemplate
+        self.sites = [Site.objects.create(domain='site{0}.example.com'.format(i),
+                                          name='Site {0}'.format(i))
+                      for i in range(2)]
+
+        for name, loops in self.TEMPLATE_SIZES:
+            EmailMessageTemplate.objects.create(
+                name=name, type='text/html', autogenerate_text=False,
+                description="{0} benchmark template".format(name),
+                **self.template_sources(loops))
+        EmailMessageTemplate.objects.create(
+            name='medium', content_type=self.content_type(),
+            object_id=self.sites[0].pk, type='text/html',
+            description="medium benchmark override", **self.template_sources(10))
+
+        for benchmark in self.benchmarks():
+            benchmark()
+
+        import django
+        return {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'repeat': self.repeat,
+            'results': self.results,
+        }
+
+    def benchmarks(self):
+        return [self.bench_get_template, self.bench_render,
+                self.bench_html_to_text, self.bench_send_mass_mail,
+                self.bench_overrides, self.bench_precompiled]
+
+    # Helpers
+
+    def template_sources(self, loops):
+        """
+        Subject, text and HTML sources whose rendered size grows with loops.
+        """
+        item = ("{{% for item in items %}}{0}{{% endfor %}}")
+        text_row = "{{ forloop.counter }}. {{ item.title }} - {{ item.price }}\n"
+        html_row = ("<tr><td><a href=\"{{ item.url }}\">{{ item.title }}</a>"
+                    "</td><td>{{ item.price }}</td></tr>\n")
+        return {
+            'subject_template': "Your order {{ order }}, {{ name|title }}",
+            'body_template': ("Hello {{ name }},\n\n" +
+                              item.format(text_row) * loops +
+                              "\nThanks,\n{{ site }}"),
+            'body_template_html': ("<html><head><title>Order</title></head>"
+                                   "<body><h1>Hello {{ name }}</h1><table>" +
+                                   item.format(html_row) * loops +
+                                   "</table><p>Thanks,<br>{{ site }}</p>"
+                                   "</body></html>"),
+        }
+
+    def context(self, i=0):
+        return {
+            'name': 'recipient {0}'.format(i),
+            'order': 1000 + i,
+            'site': 'example.com',
+            'items': [{'title': 'Item {0}'.format(n), 'price': n * 1.5,
+                       'url': 'http://example.com/items/{0}'.format(n)}
+                      for n in range(5)],
+        }
+
+    def content_type(self):
+        from django.contrib.contenttypes.models import ContentType
+        return ContentType.objects.get_for_model(self.sites[0])
+
+    def enabled(self, name):
+        return not self.only or [o for o in self.only if name.startswith(o)]
+
+    def measure(self, name, func, number=None, repeat=None, items=None,
+                **extra):
+        """
+        Time number calls of func, repeat times, and record the result.  If 
+        number isn't given, it is doubled from 1 until the calls take at 
+        least MIN_TIME seconds.  If each call processes several items (such as 
+        the messages of a bulk send), items gives their number.
+        """
+        if not self.enabled(name):
+            return
+        repeat = repeat or self.repeat
+        gc.collect()
+        times = []
+        if number is None:
+            number = 1
+            while True:
+                elapsed = self.time_calls(func, number)
+                if elapsed >= self.MIN_TIME:
+                    break
+                number *= 2
+            times.append(elapsed)
+        while len(times) < repeat:
+            times.append(self.time_calls(func, number))
+        times.sort()
+        result = {
+            'name': name,
+            'number': number,
+            'repeat': repeat,
+            'best': times[0],
+            'median': times[len(times) // 2],
+            'per_call_us': times[0] / number * 1e6,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        if items:
+            result['items'] = items
+            result['per_item_us'] = times[0] / number / items * 1e6
+        result.update(extra)
+        self.results.append(result)
+        sys.stderr.write("{name:<40} {per_call_us:>12.1f} us/call "
+                         "{max_rss_kb:>10} KB\n".format(**result))
+
+    def time_calls(self, func, number):
+        start = time.time()
+        for i in xrange(number):
+            func()
+        return time.time() - start
+
+    # Benchmarks
+
+    def bench_get_template(self):
+        from django.test.utils import override_settings
+        from emailtemplates.models import EmailMessageTemplate
+        from emailtemplates.cache import template_registry
+        get_template = EmailMessageTemplate.objects.get_template
+        override, fallback = self.sites
+
+        with override_settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=0):
+            self.measure('get_template.miss',
+                         lambda: get_template('medium'))
+            self.measure('get_template.object',
+                         lambda: get_template('medium', override))
+            self.measure('get_template.fallback',
+                         lambda: get_template('medium', fallback))
+
+        template_registry.clear()
+        with override_settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=1000):
+            get_template('medium')
+            get_template('medium', fallback)
+            self.measure('get_template.hit',
+                         lambda: get_template('medium'))
+            self.measure('get_template.fallback_hit',
+                         lambda: get_template('medium', fallback))
+        template_registry.clear()
+
+    def bench_overrides(self):
+        """
+        Lookups against OVERRIDE_ROWS per-site overrides of one template name.
+        """
+        if not self.enabled('overrides'):
+            return
+        from django.contrib.sites.models import Site
+        from django.db import connection
+        from django.test.utils import override_settings
+        from emailtemplates.models import EmailMessageTemplate
+        manager = EmailMessageTemplate.objects
+        content_type = self.content_type()
+        manager.create(name='tenant', subject_template="Hello {{ name }}",
+                       body_template="Hello {{ name }}")
+        for start in xrange(1, self.OVERRIDE_ROWS + 1, 10000):
+            manager.bulk_create([
+                EmailMessageTemplate(
+                    name='tenant', content_type=content_type, object_id=i,
+                    enabled=i % 10 != 0, subject_template="Hello {{ name }}",
+                    body_template="Hello {{ name }} of site {0}".format(i))
+                for i in xrange(start, min(start + 10000,
+                                           self.OVERRIDE_ROWS + 1))])
+        override = Site(pk=self.OVERRIDE_ROWS // 2 + 1)
+        fallback = Site(pk=self.OVERRIDE_ROWS + 1)
+        queryset = manager.override_object_ids('tenant', content_type)
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+
+        with override_settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=0):
+            self.measure('overrides.get_template.object',
+                         lambda: manager.get_template('tenant', override),
+                         rows=self.OVERRIDE_ROWS)
+            self.measure('overrides.get_template.fallback',
+                         lambda: manager.get_template('tenant', fallback),
+                         rows=self.OVERRIDE_ROWS)
+        self.measure('overrides.object_ids.exists',
+                     lambda: queryset.filter(object_id=override.pk).exists(),
+                     rows=self.OVERRIDE_ROWS, plan=plan)
+        self.measure('overrides.object_ids.list', lambda: list(queryset.all()),
+                     items=self.OVERRIDE_ROWS - self.OVERRIDE_ROWS // 10,
+                     rows=self.OVERRIDE_ROWS, plan=plan)
+
+    def bench_precompiled(self):
+        """
+        Parsing each template's HTML source against loading it precompiled.
+        """
+        from django.template import Template
+        from emailtemplates.precompiled import (dump_templates, load_templates,
+                                                load_template)
+        for size, loops in self.TEMPLATE_SIZES:
+            source = self.template_sources(loops)['body_template_html']
+            stored = dump_templates({'body': (source, Template(source))})
+            self.measure('precompiled.parse.{0}'.format(size),
+                         lambda: Template(source), input_bytes=len(source))
+            self.measure('precompiled.load.{0}'.format(size),
+                         lambda: load_template(load_templates(stored), 'body',
+                                               source),
+                         stored_bytes=len(stored))
+
+    def bench_render(self):
+        from django.template import Context
+        from emailtemplates.models import EmailMessageTemplate
+        context = Context(self.context())
+        for size, loops in self.TEMPLATE_SIZES:
+            template = EmailMessageTemplate.objects.get_template(size)
+            template.prepare()
+            for field in EmailMessageTemplate.TEMPLATE_FIELDS:
+                compiled = template.get_compiled_template(field)
+                output = len(compiled.render(context))
+                self.measure('render.{0}.{1}'.format(size, field),
+                             lambda: compiled.render(context),
+                             output_bytes=output)
+
+    def bench_html_to_text(self):
+        from django.template import Context
+        from django.test.utils import override_settings
+        from emailtemplates.converters import html2text
+        from emailtemplates.models import EmailMessageTemplate
+        from emailtemplates.converters import html_to_text
+        converters = [('simple',
+                       'emailtemplates.converters.SimpleTextConverter')]
+        if html2text is not None:
+            converters.append(('html2text',
+                               'emailtemplates.converters.Html2TextConverter'))
+
+        for size, loops in self.TEMPLATE_SIZES:
+            template = EmailMessageTemplate.objects.get_template(size)
+            html = template.get_compiled_template('body_template_html')\
+                .render(Context(self.context()))
+            for converter, path in converters:
+                with override_settings(
+                        EMAILTEMPLATES_TEXT_CONVERTER=path,
+                        EMAILTEMPLATES_TEXT_CONVERSION_CACHE_SIZE=0):
+                    self.measure('html_to_text.{0}.{1}'.format(converter, size),
+                                 lambda: html_to_text(html),
+                                 input_bytes=len(html))
+
+    def bench_send_mass_mail(self):
+        from django.core import mail
+        from emailtemplates.utils import iter_send_mass_mail
+        for count in self.MASS_MAIL_SIZES:
+            if self.max_recipients and count > self.max_recipients:
+                continue
+
+            def send():
+                datatuple = ((self.context(i), None,
+                              ['to{0}@example.com'.format(i)])
+                             for i in xrange(count))
+                mail.outbox = []
+                for sent in iter_send_mass_mail('small', datatuple=datatuple):
+                    # Don't let the locmem outbox count toward memory use
+                    del mail.outbox[:]
+            self.measure('send_mass_mail.{0}'.format(count), send, 1,
+                         repeat=1, items=count)
+
+
+if __name__ == '__main__':
+    """
+    What do when the user hits this file from the shell.
+
+    Example usage:
+
+        $ python benchmark.py --repeat 5 --output results.json
+
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(
+        description="Benchmark template lookup, rendering and sending."
+    )
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="times to repeat each measurement")
+    parser.add_argument('--max-recipients', type=int,
+                        help="skip send_mass_mail runs larger than this")
+    parser.add_argument('--output', help="write the JSON results to a file")
+    parser.add_argument('only', nargs='*',
+                        help="only run benchmarks whose names start with these")
+    args = parser.parse_args()
+    report = EmailTemplateBenchmark(args.repeat, args.max_recipients,
+                                    args.only).run()
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -1,11 +1,29 @@
 from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django import forms
 
-from models import EmailMessageTemplate
+from models import EmailMessageTemplate, QueuedMessage
 from forms import EmailListField
 
 
+class EmailMessageTemplateChangeList(ChangeList):
+    """
+    Leaves the template bodies and other large fields out of the changelist 
+    query, since no list column shows them.
+    """
+
+    def get_queryset(self, request):
+        parent = super(EmailMessageTemplateChangeList, self)
+        if hasattr(parent, 'get_queryset'):
+            queryset = parent.get_queryset(request)
+        else:
+            #Django < 1.6
+            queryset = parent.get_query_set(request)
+        return queryset.defer(*EmailMessageTemplate.DEFERRED_FIELDS)
+    get_query_set = get_queryset
+
+
 class EmailMessageTemplateAdmin(admin.ModelAdmin):
     readonly_fields = ('related_item_display',)
     
@@ -21,9 +39,20 @@ class EmailMessageTemplateAdmin(admin.ModelAdmin):
             return db_field.formfield(form_class=EmailListField, **kwargs)
         return super(EmailMessageTemplateAdmin, self).formfield_for_dbfield(db_field, **kwargs)
     
+    def get_changelist(self, request, **kwargs):
+        return EmailMessageTemplateChangeList
+
     class Media:
         js = (
             'emailtemplates/js/admin.js',
             )
     
 admin.site.register(EmailMessageTemplate, EmailMessageTemplateAdmin)
+
+
+class QueuedMessageAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'status', 'attempts', 'next_attempt', 'created_date')
+    list_filter = ('status',)
+    raw_id_fields = ('template',)
+
+admin.site.register(QueuedMessage, QueuedMessageAdmin)
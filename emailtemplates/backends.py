@@ -0,0 +1,81 @@
+"""
+Email backends for delivering large numbers of templated messages
+"""
+import threading
+
+from django.core.mail.backends.smtp import EmailBackend
+
+from conf import settings
+
+
+class ConcurrentSMTPBackend(EmailBackend):
+    """
+    An SMTP backend that delivers each batch of messages over several 
+    connections at once.  The messages are divided between up to 
+    `concurrency` connections (EMAILTEMPLATES_SMTP_CONCURRENCY by default), 
+    each of which sends its share in turn from its own thread, so slow 
+    server responses for one message don't hold up the others.
+
+    As with Django's SMTP backend, connections are kept open between batches 
+    while the backend is open, and closed by close().
+    """
+
+    def __init__(self, concurrency=None, **kwargs):
+        super(ConcurrentSMTPBackend, self).__init__(**kwargs)
+        self.concurrency = concurrency or \
+            settings.EMAILTEMPLATES_SMTP_CONCURRENCY
+        self._backends = []
+
+    def close(self):
+        """Closes all connections to the email server."""
+        try:
+            for backend in self._backends:
+                backend.close()
+        finally:
+            self._backends = []
+            super(ConcurrentSMTPBackend, self).close()
+
+    def send_messages(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns the number of email 
+        messages sent.
+        """
+        if not email_messages:
+            return
+        count = min(self.concurrency, len(email_messages))
+        if count < 2:
+            return super(ConcurrentSMTPBackend, self).send_messages(
+                email_messages)
+
+        keep_open = self.connection is not None
+        while len(self._backends) < count - 1:
+            self._backends.append(EmailBackend(
+                host=self.host, port=self.port, username=self.username,
+                password=self.password, use_tls=self.use_tls,
+                fail_silently=self.fail_silently))
+
+        results = [0] * count
+        errors = []
+        def deliver(index, backend):
+            try:
+                if keep_open:
+                    backend.open()
+                results[index] = backend.send_messages(
+                    email_messages[index::count]) or 0
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=deliver, args=(index, backend))
+                   for index, backend in enumerate(self._backends[:count - 1],
+                                                   1)]
+        for thread in threads:
+            thread.start()
+        try:
+            results[0] = super(ConcurrentSMTPBackend, self).send_messages(
+                email_messages[0::count]) or 0
+        finally:
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return sum(results)
@@ -0,0 +1,30 @@
+"""
+Sending of messages in a shared pool of background threads
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from conf import settings
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the process's background send pool, starting it with 
+    EMAILTEMPLATES_BACKGROUND_WORKERS threads if necessary.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.EMAILTEMPLATES_BACKGROUND_WORKERS)
+    return _pool
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+    Call func in the background send pool and return an AsyncResult for the 
+    call.
+    """
+    return get_pool().apply_async(func, args, kwargs)
@@ -0,0 +1,280 @@
+"""
+Process-wide caches used to avoid repeating expensive template work
+"""
+import hashlib
+import threading
+import time
+
+from django.core.cache import get_cache
+from django.core.cache.backends import base as cache_base
+from django.db import connections, transaction
+
+from conf import settings
+
+
+class LRUCache(object):
+    """
+    A small thread-safe mapping that discards the least recently used entries
+    once it holds more than ``maxsize`` items.  ``maxsize`` may be a callable
+    so that the limit can follow a setting that changes at runtime; a limit of
+    0 disables the cache entirely.
+    """
+    # Indexes into the [prev, next, key, value] links of the recency list
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, maxsize=128):
+        self._maxsize = maxsize
+        self._lock = threading.RLock()
+        self.clear()
+
+    @property
+    def maxsize(self):
+        if callable(self._maxsize):
+            return self._maxsize()
+        return self._maxsize
+
+    def clear(self):
+        with self._lock:
+            self._map = {}
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key, marking it as most recently used.
+        """
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[self.VALUE]
+
+    def set(self, key, value):
+        """
+        Store value under key, evicting the oldest entries if necessary.
+        """
+        maxsize = self.maxsize
+        if not maxsize:
+            return
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[self.VALUE] = value
+            else:
+                link = [None, None, key, value]
+                self._map[key] = link
+            self._append(link)
+            while len(self._map) > maxsize:
+                oldest = self._root[self.NEXT]
+                self._unlink(oldest)
+                del self._map[oldest[self.KEY]]
+
+    def delete(self, key):
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+
+    def delete_matching(self, predicate):
+        """
+        Remove every entry whose key satisfies predicate.
+        """
+        with self._lock:
+            for key in [k for k in self._map if predicate(k)]:
+                self.delete(key)
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _append(self, link):
+        last = self._root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self._root
+        last[self.NEXT] = link
+        self._root[self.PREV] = link
+
+
+#: Compiled ``Template`` objects, keyed by (template pk, field, edited_date)
+compiled_templates = LRUCache(
+    lambda: settings.EMAILTEMPLATES_COMPILED_TEMPLATE_CACHE_SIZE)
+
+#: Templates compiled while validating template fields, keyed by a hash of
+#: their source, so that they needn't be compiled again once saved
+validated_templates = LRUCache(
+    lambda: settings.EMAILTEMPLATES_COMPILED_TEMPLATE_CACHE_SIZE)
+
+
+def source_key(source):
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).digest()
+
+#: (expiry time, field values or None) for enabled templates, keyed by
+#: (name, content type pk, object id)
+template_registry = LRUCache(
+    lambda: settings.EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE)
+
+#: Plain text autogenerated from HTML content, keyed by a hash of the HTML
+text_conversions = LRUCache(
+    lambda: settings.EMAILTEMPLATES_TEXT_CONVERSION_CACHE_SIZE)
+
+
+# Shared template cache
+#
+# Template rows can also be stored in a Django cache (usually memcached or
+# redis) shared by all processes.  Keys include a version number that is
+# bumped whenever a template is saved or deleted, which retires every
+# existing entry at once.  Versions start from the current time in
+# microseconds, which saves can't outpace, so that a version key evicted from
+# the cache never revives older entries.  Rows are only stored under the
+# version read before they were fetched, and only if it is still current, and
+# a change made in a transaction bumps the version again once the transaction
+# ends, so that rows read by other processes before it was committed are
+# retired too.
+
+SHARED_VERSION_KEY = 'emailtemplates:version'
+if hasattr(cache_base, 'DEFAULT_TIMEOUT'):
+    #Stored without a timeout
+    _VERSION_TIMEOUT = None
+else:
+    #Django < 1.6 reads a timeout of None as the default timeout
+    _VERSION_TIMEOUT = 30 * 24 * 60 * 60
+_shared_caches = {}
+#Database aliases with a bump waiting for the end of a transaction, per thread
+_pending_bumps = threading.local()
+
+
+def get_shared_cache():
+    """
+    Return the cache backend named by EMAILTEMPLATES_TEMPLATE_CACHE, or None 
+    if the shared cache is disabled.
+    """
+    alias = settings.EMAILTEMPLATES_TEMPLATE_CACHE
+    if not alias:
+        return None
+    if alias not in _shared_caches:
+        _shared_caches[alias] = get_cache(alias)
+    return _shared_caches[alias]
+
+
+def _shared_key(version, key):
+    raw = u"\x00".join([unicode(part) for part in key])
+    #Rows leave out the deferred body fields since version 2 of the key
+    return 'emailtemplates:template2:{0}:{1}'.format(
+        version, hashlib.md5(raw.encode('utf-8')).hexdigest())
+
+
+def get_shared_version():
+    """
+    Return the current version of the shared cache, or None if it is 
+    disabled.  Read this once before querying the database, and pass it to 
+    set_shared_rows along with the rows fetched.
+    """
+    cache = get_shared_cache()
+    if cache is None:
+        return None
+    flush_shared_version()
+    version = cache.get(SHARED_VERSION_KEY)
+    if version is None:
+        #Checked first, as some backends' add() overwrites keys stored 
+        #without a timeout
+        _seed(cache)
+        version = cache.get(SHARED_VERSION_KEY)
+    return version
+
+
+def get_shared_rows(keys, version):
+    """
+    Look up template rows for several (name, content type pk, object id) keys 
+    in the shared cache, under the given version.  Returns a dictionary 
+    containing the keys that were found, mapped to a row or, for cached 
+    misses, None.
+    """
+    cache = get_shared_cache()
+    if cache is None or version is None or not keys:
+        return {}
+    cache_keys = dict((_shared_key(version, key), key) for key in keys)
+    rows = {}
+    for cache_key, row in cache.get_many(cache_keys.keys()).items():
+        rows[cache_keys[cache_key]] = row or None
+    return rows
+
+
+def set_shared_rows(rows, version):
+    """
+    Store a dictionary of keys to rows (or None for misses) in the shared 
+    cache, under the version read before the rows were fetched.  Nothing is 
+    stored if the version has changed since, as the rows may predate the 
+    change.
+    """
+    cache = get_shared_cache()
+    if cache is None or version is None or not rows:
+        return
+    if cache.get(SHARED_VERSION_KEY) != version:
+        return
+    cache.set_many(dict((_shared_key(version, key), row or ())
+                        for key, row in rows.items()),
+                   settings.EMAILTEMPLATES_TEMPLATE_CACHE_TIMEOUT)
+
+
+def bump_shared_version(using=None):
+    """
+    Retire every template row stored in the shared cache.  If the database 
+    connection given by using is in a transaction, the change that prompted 
+    this isn't visible to other processes yet, and they may cache the old 
+    rows under the new version in the meantime, so the version is bumped 
+    again once the transaction has ended (see flush_shared_version).
+    """
+    cache = get_shared_cache()
+    if cache is None:
+        return
+    _bump(cache)
+    if using is not None and _in_transaction(using):
+        _pending_bumps.__dict__.setdefault('aliases', set()).add(using)
+
+
+def flush_shared_version(**kwargs):
+    """
+    Make any bump deferred by bump_shared_version whose transaction has 
+    ended.  Called at the end of each request, and before this thread next 
+    uses the shared cache.
+    """
+    aliases = getattr(_pending_bumps, 'aliases', None)
+    if not aliases:
+        return
+    ended = set(using for using in aliases if not _in_transaction(using))
+    if ended:
+        aliases.difference_update(ended)
+        cache = get_shared_cache()
+        if cache is not None:
+            _bump(cache)
+
+
+def _bump(cache):
+    try:
+        cache.incr(SHARED_VERSION_KEY)
+    except ValueError:
+        _seed(cache)
+
+
+def _seed(cache):
+    cache.add(SHARED_VERSION_KEY, int(time.time() * 1000000),
+              _VERSION_TIMEOUT)
+
+
+def _in_transaction(using):
+    connection = connections[using]
+    if hasattr(connection, 'in_atomic_block'):
+        return connection.in_atomic_block or not connection.get_autocommit()
+    #Django < 1.6
+    return transaction.is_managed(using=using)
@@ -13,4 +13,131 @@ class MyAppConf(AppConf):
     """
     If true, templates can produce HTML-formatted messages and provide 
     plain-text alternative content.
-    """
\ No newline at end of file
+    """
+    
+    CONTEXT_SCHEMAS = {}
+    """
+    Maps template names to the context variable names templates with that 
+    name may use.  Templates are checked against their schema when they're 
+    validated (e.g. when saved in the admin).
+    """
+    
+    COMPILED_TEMPLATE_CACHE_SIZE = 500
+    """
+    The number of compiled subject and body templates kept in memory by each 
+    process.  Set to 0 to compile templates every time they are rendered.
+    """
+    
+    PRECOMPILE_TEMPLATES = False
+    """
+    If true, templates store their compiled subject and body templates when 
+    saved, so that new processes can load them instead of parsing the 
+    sources.
+    """
+    
+    MASS_MAIL_CHUNK_SIZE = 500
+    """
+    The number of messages send_mass_mail renders and hands to the email 
+    backend at a time.
+    """
+    
+    RENDER_WORKERS = 0
+    """
+    The number of workers send_mass_mail uses to render messages in 
+    parallel.  0 renders messages in the sending process.
+    """
+    
+    RENDER_POOL = 'process'
+    """
+    The kind of worker pool used when RENDER_WORKERS is set: 'process' or 
+    'thread'.
+    """
+    
+    TEMPLATE_REGISTRY_SIZE = 0
+    """
+    The number of template lookups (including lookups that found no 
+    template) each process remembers, so that get_template does not query 
+    the database every time.  0 disables the registry.
+    """
+    
+    TEMPLATE_REGISTRY_TTL = 300
+    """
+    The number of seconds a remembered template lookup is trusted.  Saving or 
+    deleting a template clears the registry of the process that made the 
+    change; other processes pick up changes when their entries expire.
+    """
+    
+    TEMPLATE_CACHE = None
+    """
+    The alias of a cache in the CACHES setting, shared between processes, in 
+    which template lookups are stored.  None disables the shared cache.
+    """
+    
+    TEMPLATE_CACHE_TIMEOUT = 3600
+    """
+    The number of seconds template lookups are kept in the shared cache.
+    """
+    
+    TEXT_CONVERSION_CACHE_SIZE = 100
+    """
+    The number of plain text bodies autogenerated from HTML content that each 
+    process remembers, so identical HTML is only converted once.  Set to 0 
+    to convert every message.
+    """
+    
+    TEXT_CONVERTER = 'emailtemplates.converters.Html2TextConverter'
+    """
+    The dotted path of the class used to autogenerate plain text bodies from 
+    HTML content.  emailtemplates.converters.SimpleTextConverter is a faster 
+    alternative that doesn't need the html2text library.
+    """
+    
+    BACKGROUND_WORKERS = 4
+    """
+    The number of threads each process uses to deliver messages sent with 
+    send_async, send_mail_async and send_mass_mail_async.  This limits how 
+    many such sends run at once.
+    """
+    
+    SMTP_CONCURRENCY = 4
+    """
+    The number of SMTP connections ConcurrentSMTPBackend uses at once to 
+    deliver a batch of messages.
+    """
+    
+    CONNECTION_POOL_SIZE = 4
+    """
+    The maximum number of idle connections kept open for reuse by send_mail 
+    and the other helper functions, for each backend and login.  Set to 0 to 
+    open a new connection for every call.
+    """
+    
+    CONNECTION_POOL_IDLE_TIMEOUT = 60
+    """
+    The number of seconds a pooled connection may stay idle before it is 
+    closed instead of reused.
+    """
+    
+    QUEUE_BATCH_SIZE = 100
+    """
+    The number of queued messages the worker claims and sends over one 
+    connection at a time.
+    """
+    
+    QUEUE_MAX_ATTEMPTS = 5
+    """
+    The number of times the worker tries to send a queued message before 
+    marking it as failed.
+    """
+    
+    QUEUE_RETRY_DELAY = 60
+    """
+    The number of seconds the worker waits before retrying a queued message 
+    that couldn't be sent.  The delay doubles after each further attempt.
+    """
+    
+    QUEUE_LEASE = 300
+    """
+    The number of seconds after which a queued message claimed by a worker 
+    that has not sent it may be claimed by another worker.
+    """
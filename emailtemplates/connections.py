@@ -0,0 +1,144 @@
+"""
+A pool of open email backend connections shared by the convenience functions
+"""
+import smtplib
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.mail import get_connection
+
+from conf import settings
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of open email backend connections, keyed by backend
+    and login.  A connection is used by one caller at a time: it is taken
+    from the pool by acquire() and returned by release().
+
+    Connections that have been idle for longer than
+    EMAILTEMPLATES_CONNECTION_POOL_IDLE_TIMEOUT seconds are closed rather than
+    reused, and SMTP connections are checked with a NOOP command before
+    reuse, so a connection dropped by the server is replaced with a new one.
+    The extra connections of a ConcurrentSMTPBackend are checked too, and
+    any that have dropped are closed, to be reopened by its next send.
+    At most EMAILTEMPLATES_CONNECTION_POOL_SIZE idle connections are kept for
+    each key.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, username=None, password=None, fail_silently=False):
+        """
+        Return an open connection for the default email backend and the given
+        login, reusing an idle one if possible.
+        """
+        key = (settings.EMAIL_BACKEND, username, password)
+        now = time.time()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                connection, last_used = idle.pop()
+            timeout = settings.EMAILTEMPLATES_CONNECTION_POOL_IDLE_TIMEOUT
+            if now - last_used <= timeout and self._is_healthy(connection):
+                connection.fail_silently = fail_silently
+                return connection
+            self._close(connection)
+
+        connection = get_connection(username=username, password=password,
+                                    fail_silently=fail_silently)
+        connection._pool_key = key
+        connection.open()
+        return connection
+
+    def release(self, connection):
+        """
+        Return a connection to the pool, closing it if the pool is full.
+        """
+        key = getattr(connection, '_pool_key', None)
+        if key is not None:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < settings.EMAILTEMPLATES_CONNECTION_POOL_SIZE:
+                    idle.append((connection, time.time()))
+                    return
+        self._close(connection)
+
+    def discard(self, connection):
+        """
+        Close a connection taken from the pool that shouldn't be reused.
+        """
+        self._close(connection)
+
+    def close_all(self):
+        """
+        Close every idle connection in the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, last_used in connections:
+                self._close(connection)
+
+    def _is_healthy(self, connection):
+        for backend in getattr(connection, '_backends', ()):
+            if not self._responds(backend):
+                self._close(backend)
+        return self._responds(connection)
+
+    def _responds(self, connection):
+        smtp = getattr(connection, 'connection', None)
+        if smtp is None or not hasattr(smtp, 'noop'):
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+connection_pool = ConnectionPool()
+
+
+@contextmanager
+def pooled_connection(connection=None, username=None, password=None,
+                      fail_silently=False):
+    """
+    Provide a connection for the duration of a with block: the given
+    connection if there is one, otherwise one from the shared pool (or a new
+    one if EMAILTEMPLATES_CONNECTION_POOL_SIZE is 0).  Pooled connections
+    are returned to the pool afterwards, unless an SMTP or socket error (or
+    an interruption) may have left them broken; other errors, such as
+    failures to render a template, don't affect the connection.
+    """
+    if connection is not None:
+        yield connection
+    elif not settings.EMAILTEMPLATES_CONNECTION_POOL_SIZE:
+        yield get_connection(username=username, password=password,
+                             fail_silently=fail_silently)
+    else:
+        connection = connection_pool.acquire(username, password,
+                                             fail_silently)
+        try:
+            yield connection
+        except Exception as e:
+            if isinstance(e, (smtplib.SMTPException, socket.error)):
+                connection_pool.discard(connection)
+            else:
+                connection_pool.release(connection)
+            raise
+        except:
+            connection_pool.discard(connection)
+            raise
+        connection_pool.release(connection)
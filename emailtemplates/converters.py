@@ -0,0 +1,220 @@
+"""
+Converters used to autogenerate plain text bodies from HTML content
+
+A converter is any class whose instances have a ``convert(html)`` method
+returning plain text, and an ``available`` attribute that is false if the
+converter can't be used (for example, because a library is missing).  The
+converter to use is set with the EMAILTEMPLATES_TEXT_CONVERTER setting.
+"""
+import hashlib
+import re
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+try:
+    import html2text
+except ImportError:
+    html2text = None
+
+from conf import settings
+from cache import text_conversions
+from signals import record_cache_access
+
+
+class Html2TextConverter(object):
+    """
+    Converts HTML to Markdown-formatted text with the html2text library.
+    """
+
+    @property
+    def available(self):
+        return html2text is not None
+
+    def convert(self, html):
+        return html2text.html2text(html)
+
+
+class SimpleTextConverter(object):
+    """
+    A fast converter built on the standard library's HTMLParser.  It handles
+    the markup typically found in email templates: paragraphs and line
+    breaks, headings, links, ordered and unordered lists, tables and images,
+    and drops scripts, styles and the document head.
+    """
+    available = True
+
+    def convert(self, html):
+        parser = _TextParser()
+        parser.feed(html)
+        parser.close()
+        return parser.text()
+
+
+class _TextParser(HTMLParser):
+    BLOCK_TAGS = set(['p', 'div', 'table', 'ul', 'ol', 'dl', 'blockquote',
+                      'pre', 'address', 'center', 'section', 'article',
+                      'header', 'footer', 'form'])
+    HEADING_TAGS = set(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+    SKIP_TAGS = set(['head', 'title', 'script', 'style'])
+    WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.parts = []
+        self.newlines = 0
+        self.skip = 0
+        self.pre = 0
+        self.lists = []
+        self.links = []
+        self.cells = 0
+
+    def text(self):
+        lines = [line.rstrip() for line in u''.join(self.parts).split(u'\n')]
+        return re.sub(r'\n{3,}', u'\n\n', u'\n'.join(lines)).strip()
+
+    def write(self, data):
+        if self.newlines and not self.pre:
+            data = data.lstrip(u' ')
+        elif data.startswith(u' ') and self.parts and \
+                self.parts[-1].endswith(u' '):
+            data = data[1:]
+        if data:
+            self.parts.append(data)
+            self.newlines = 0
+
+    def line_break(self, count=1):
+        """
+        Ensure the output ends with at least count newlines.
+        """
+        if self.parts and self.newlines < count:
+            self.parts.append(u'\n' * (count - self.newlines))
+            self.newlines = count
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.line_break(1 if self.lists and tag in ('ul', 'ol') else 2)
+            if tag == 'pre':
+                self.pre += 1
+            elif tag == 'ul':
+                self.lists.append(None)
+            elif tag == 'ol':
+                self.lists.append(0)
+        elif tag in self.HEADING_TAGS:
+            self.line_break(2)
+            self.write(u'#' * int(tag[1]) + u' ')
+        elif tag == 'li':
+            self.line_break(1)
+            marker = u'* '
+            if self.lists and self.lists[-1] is not None:
+                self.lists[-1] += 1
+                marker = u'{0}. '.format(self.lists[-1])
+            self.parts.append(u'  ' * max(len(self.lists) - 1, 0) + marker)
+            self.newlines = 0
+        elif tag == 'br':
+            self.parts.append(u'\n')
+            self.newlines += 1
+        elif tag == 'tr':
+            self.line_break(1)
+            self.cells = 0
+        elif tag in ('td', 'th'):
+            if self.cells:
+                self.write(u'\t')
+            self.cells += 1
+        elif tag == 'hr':
+            self.line_break(2)
+            self.write(u'* * *')
+            self.line_break(2)
+        elif tag == 'a':
+            self.links.append((attrs.get('href'), len(self.parts)))
+        elif tag == 'img' and attrs.get('alt'):
+            self.write(attrs['alt'])
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            if tag == 'pre':
+                self.pre = max(self.pre - 1, 0)
+            elif tag in ('ul', 'ol') and self.lists:
+                self.lists.pop()
+                if self.lists:
+                    self.line_break(1)
+                    return
+            self.line_break(2)
+        elif tag in self.HEADING_TAGS:
+            self.line_break(2)
+        elif tag == 'a' and self.links:
+            href, start = self.links.pop()
+            label = u''.join(self.parts[start:]).strip()
+            if href and not href.startswith('#') and \
+                    href not in (label, u'mailto:' + label):
+                self.write(u' ({0})'.format(href))
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        if not self.pre:
+            data = self.WHITESPACE.sub(u' ', data)
+        self.write(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u'&{0};'.format(name))
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in ('x', 'X'):
+                self.handle_data(unichr(int(name[1:], 16)))
+            else:
+                self.handle_data(unichr(int(name)))
+        except ValueError:
+            self.handle_data(u'&#{0};'.format(name))
+
+
+_converters = {}
+
+
+def get_converter():
+    """
+    Return an instance of the converter named by the
+    EMAILTEMPLATES_TEXT_CONVERTER setting.
+    """
+    path = settings.EMAILTEMPLATES_TEXT_CONVERTER
+    if path not in _converters:
+        module_name, _, class_name = path.rpartition('.')
+        try:
+            converter_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError, ValueError) as e:
+            raise ImproperlyConfigured(
+                "Error importing text converter {0}: {1}".format(path, e))
+        _converters[path] = converter_class()
+    return _converters[path]
+
+
+def html_to_text(html, template_name=None):
+    """
+    Convert rendered HTML content to plain text with the configured
+    converter, or return None if it isn't available.  Conversions are
+    remembered by a hash of the HTML, so identical content is only converted
+    once.  template_name is only used to label instrumentation signals.
+    """
+    converter = get_converter()
+    if not converter.available:
+        return None
+    key = (settings.EMAILTEMPLATES_TEXT_CONVERTER,
+           hashlib.sha1(html.encode('utf-8')).digest())
+    text = text_conversions.get(key)
+    if text is None:
+        record_cache_access('conversion', template_name, misses=1)
+        text = converter.convert(html)
+        text_conversions.set(key, text)
+    else:
+        record_cache_access('conversion', template_name, hits=1)
+    return text
@@ -1,7 +1,10 @@
 from django.conf import settings
 from django.db import models
 from django.core.exceptions import ValidationError
-from django.template import Context, Template, TemplateSyntaxError
+from django.template import Template, TemplateSyntaxError
+
+from cache import LRUCache, validated_templates, source_key
+from rendering import context_names
 
 if 'south' in settings.INSTALLED_APPS:
     from south.modelsinspector import add_introspection_rules
@@ -17,12 +20,27 @@ class SeparatedValuesField(models.TextField):
         self.token = kwargs.pop('token', ',')
         super(SeparatedValuesField, self).__init__(*args, **kwargs)
 
+    #Parsed values, keyed by (token, stored string), shared by every field
+    _parsed = LRUCache(1000)
+
     def to_python(self, value):
+        """
+        Split a stored string into a list of values, stripping whitespace and 
+        dropping blank values.  Each distinct string is only parsed once.
+        """
         if not value:
             return
         if isinstance(value, list):
             return value
-        return value.split(self.token)
+        if isinstance(value, tuple):
+            return list(value)
+        key = (self.token, value)
+        parsed = self._parsed.get(key)
+        if parsed is None:
+            parsed = tuple(v.strip() for v in value.split(self.token)
+                           if v.strip())
+            self._parsed.set(key, parsed)
+        return list(parsed)
 
     def get_prep_value(self, value):
         if not value:
@@ -35,11 +53,52 @@ class SeparatedValuesField(models.TextField):
         return ",".join(value)
 
 
+def unique_addresses(addresses):
+    """
+    Return a list of addresses with surrounding whitespace removed, and blank 
+    and repeated addresses dropped, in their original order.
+    """
+    seen = set()
+    unique = []
+    for address in addresses:
+        address = address.strip()
+        if address and address not in seen:
+            seen.add(address)
+            unique.append(address)
+    return unique
+
+
 def validate_template_syntax(value):
     """
-    Ensure that there aren't any gross errors in a template string
+    Ensure that there aren't any gross errors in a template string.  The 
+    template is only compiled, not rendered, and the compiled template is 
+    kept so that it can be reused once the template is saved.
+    """
+    compile_template(value)
+
+
+def validate_template_context(value, names):
+    """
+    Ensure that a template string only uses context variables from names.  
+    Variables bound by {% for %} and {% with %} tags are allowed.
+    """
+    unknown = context_names(compile_template(value).nodelist) - set(names)
+    if unknown:
+        raise ValidationError("Unknown template variables: " +
+                              ", ".join(sorted(unknown)))
+
+
+def compile_template(value):
+    """
+    Compile a template string, reusing the template compiled when it was last 
+    validated, if any.  Raises ValidationError for invalid templates.
     """
-    try:
-        Template(value).render(Context({}))
-    except TemplateSyntaxError, e:
-        raise ValidationError("Invalid Template Syntax: " + e.message)
+    key = source_key(value)
+    template = validated_templates.get(key)
+    if template is None:
+        try:
+            template = Template(value)
+        except TemplateSyntaxError, e:
+            raise ValidationError("Invalid Template Syntax: " + e.message)
+        validated_templates.set(key, template)
+    return template
@@ -0,0 +1,120 @@
+"""
+A database-backed queue of messages to be sent by a separate worker process
+"""
+import json
+import smtplib
+import socket
+import uuid
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template import Context
+from django.utils import timezone
+
+from conf import settings
+from models import QueuedMessage, TemplatedMessage
+from connections import pooled_connection
+from signals import timed
+
+
+def enqueue(template, context, from_email, recipient_list):
+    """
+    Store a message to be rendered from template and sent by the worker, and
+    return the QueuedMessage.  The context is stored as JSON, so its values
+    must be JSON serializable (dates and decimals are converted to strings).
+    """
+    if isinstance(context, Context):
+        values = {}
+        for d in context.dicts:
+            values.update(d)
+        context = values
+    return QueuedMessage.objects.create(
+        template=template,
+        context=json.dumps(context or {}, cls=DjangoJSONEncoder),
+        from_email=from_email or '',
+        recipients=list(recipient_list))
+
+
+def process_queue(batch_size=None, token=None):
+    """
+    Claim a batch of due messages (EMAILTEMPLATES_QUEUE_BATCH_SIZE by
+    default) and send them over a single connection.  Sent messages are
+    deleted.  Messages that can't be sent are retried after
+    EMAILTEMPLATES_QUEUE_RETRY_DELAY seconds, doubling for each further
+    attempt, and are marked as failed after EMAILTEMPLATES_QUEUE_MAX_ATTEMPTS
+    attempts.  If the connection fails and can't be reopened, the rest of
+    the batch is released, to be claimed again without counting an attempt.
+    Returns a (sent, failed) tuple of message counts.
+    """
+    batch_size = batch_size or settings.EMAILTEMPLATES_QUEUE_BATCH_SIZE
+    token = token or uuid.uuid4().hex
+    jobs = QueuedMessage.objects.claim(batch_size, token,
+                                       settings.EMAILTEMPLATES_QUEUE_LEASE)
+    if not jobs:
+        return 0, 0
+
+    sent = failed = 0
+    with pooled_connection() as connection:
+        new_connection = connection.open()
+        try:
+            for i, job in enumerate(jobs):
+                try:
+                    if not job.template.enabled:
+                        raise ValueError("Template {0} is disabled".format(
+                                job.template.pk))
+                    message = TemplatedMessage(
+                        job.template, json.loads(job.context or '{}'),
+                        job.from_email or None, job.recipients, connection)
+                    with timed('send', job.template.name):
+                        connection.send_messages([message])
+                except (smtplib.SMTPException, socket.error) as e:
+                    failed += 1
+                    _retry_later(job, e)
+                    #The backend keeps a dropped connection, so reconnect
+                    #rather than failing the rest of the batch on it
+                    if not _reconnect(connection):
+                        _release(jobs[i + 1:], token)
+                        break
+                except Exception as e:
+                    failed += 1
+                    _retry_later(job, e)
+                else:
+                    #Deleted at once, so a crash doesn't send it again
+                    job.delete()
+                    sent += 1
+        finally:
+            if new_connection:
+                connection.close()
+    return sent, failed
+
+
+def _reconnect(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+    try:
+        connection.open()
+    except (smtplib.SMTPException, socket.error):
+        return False
+    return True
+
+
+def _release(jobs, token):
+    QueuedMessage.objects.filter(pk__in=[job.pk for job in jobs],
+                                 claimed_by=token)\
+        .update(claimed_by=None, claimed_date=None)
+
+
+def _retry_later(job, error):
+    job.attempts += 1
+    job.last_error = u"{0}: {1}".format(type(error).__name__, error)
+    if job.attempts >= settings.EMAILTEMPLATES_QUEUE_MAX_ATTEMPTS:
+        job.status = QueuedMessage.FAILED
+    else:
+        delay = settings.EMAILTEMPLATES_QUEUE_RETRY_DELAY * \
+            2 ** (job.attempts - 1)
+        job.next_attempt = timezone.now() + timedelta(seconds=delay)
+    job.claimed_by = None
+    job.claimed_date = None
+    job.save()
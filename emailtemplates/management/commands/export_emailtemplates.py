@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from emailtemplates.models import EmailMessageTemplate
+from emailtemplates.transfer import export_templates
+
+
+class Command(BaseCommand):
+    args = '[template name ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output',
+                    help="The file to write to (standard output by default)."),
+    )
+    help = ("Writes email templates (all of them, or those with the given "
+            "names) as JSON Lines, for use with import_emailtemplates.")
+
+    def handle(self, *names, **options):
+        queryset = EmailMessageTemplate.objects.all()
+        if names:
+            queryset = queryset.filter(name__in=names)
+        output = options.get('output')
+        if output:
+            with open(output, 'w') as out:
+                count = export_templates(out, queryset)
+        else:
+            count = export_templates(self.stdout, queryset)
+        if int(options.get('verbosity', 1)) and output:
+            self.stdout.write(u"Exported {0} templates".format(count))
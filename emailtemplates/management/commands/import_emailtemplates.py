@@ -0,0 +1,40 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emailtemplates.transfer import import_templates, TemplateImportError
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help="The number of templates to validate and save at once."),
+        make_option('--workers', type='int', dest='workers', default=0,
+                    help="Compile templates in this many worker processes."),
+        make_option('--no-validate', action='store_false', dest='validate',
+                    default=True, help="Don't check templates before saving."),
+    )
+    help = ("Creates or updates email templates from a JSON Lines file written "
+            "by export_emailtemplates ('-' reads standard input).")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give one file to import.")
+        if args[0] == '-':
+            lines = sys.stdin
+        else:
+            lines = open(args[0])
+        try:
+            created, updated, unchanged = import_templates(
+                lines, options['batch_size'], options['workers'],
+                options['validate'])
+        except TemplateImportError as e:
+            raise CommandError(u"Templates not imported:\n{0}".format(e))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write(u"Created {0}, updated {1}, unchanged {2} "
+                              u"templates".format(created, updated, unchanged))
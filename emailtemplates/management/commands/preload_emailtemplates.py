@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from emailtemplates.models import EmailMessageTemplate
+
+
+class Command(BaseCommand):
+    args = '[template name ...]'
+    help = ("Loads and compiles enabled email templates (all of them, or those "
+            "with the given names) and populates the template caches.")
+
+    def handle(self, *names, **options):
+        verbosity = int(options.get('verbosity', 1))
+        timings = EmailMessageTemplate.objects.warm(list(names) or None)
+        if not verbosity:
+            return
+        total = 0
+        for template, seconds in timings:
+            total += seconds
+            self.stdout.write(u"{0}: {1:.2f} ms".format(template,
+                                                       seconds * 1000))
+        self.stdout.write(u"Preloaded {0} templates in {1:.2f} ms".format(
+                len(timings), total * 1000))
@@ -0,0 +1,36 @@
+import time
+import uuid
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from emailtemplates.mailqueue import process_queue
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    help="The number of messages to send over each connection."),
+        make_option('--interval', type='float', dest='interval', default=5,
+                    help="Seconds to wait before checking an empty queue again."),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help="Exit once no messages are due instead of waiting."),
+    )
+    help = ("Sends messages queued with send_mail(..., queue=True), in batches "
+            "over a single connection, retrying failed messages with backoff.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        token = uuid.uuid4().hex
+        try:
+            while True:
+                sent, failed = process_queue(options.get('batch_size'), token)
+                if verbosity and (sent or failed):
+                    self.stdout.write(u"Sent {0} messages, {1} failed".format(
+                            sent, failed))
+                if not (sent or failed):
+                    if options.get('once'):
+                        return
+                    time.sleep(options.get('interval'))
+        except KeyboardInterrupt:
+            pass
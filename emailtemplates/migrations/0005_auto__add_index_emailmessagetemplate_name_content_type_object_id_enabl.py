@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'EmailMessageTemplate', fields ['name', 'content_type', 'object_id', 'enabled']
+        db.create_index(u'emailtemplates_emailmessagetemplate', ['name', 'content_type_id', 'object_id', 'enabled'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'EmailMessageTemplate', fields ['name', 'content_type', 'object_id', 'enabled']
+        db.delete_index(u'emailtemplates_emailmessagetemplate', ['name', 'content_type_id', 'object_id', 'enabled'])
+
+
+    models = {
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'emailtemplates.emailmessagetemplate': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('name', 'content_type', 'object_id'),)", 'object_name': 'EmailMessageTemplate', 'index_together': "(('name', 'content_type', 'object_id', 'enabled'),)"},
+            'autogenerate_text': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'base_bcc': ('emailtemplates.fields.SeparatedValuesField', [], {'default': "''", 'blank': 'True'}),
+            'base_cc': ('emailtemplates.fields.SeparatedValuesField', [], {'default': "''", 'blank': 'True'}),
+            'body_template': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'body_template_html': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edited_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'edited_user': ('django.db.models.fields.TextField', [], {'max_length': '30', 'blank': 'True'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'sender': ('django.db.models.fields.EmailField', [], {'default': "''", 'max_length': '75', 'blank': 'True'}),
+            'subject_template': ('django.db.models.fields.CharField', [], {'max_length': '2000'}),
+            'type': ('django.db.models.fields.CharField', [], {'default': "'text/plain'", 'max_length': '20'}),
+            'variable_index': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        },
+        u'emailtemplates.queuedmessage': {
+            'Meta': {'ordering': "('next_attempt',)", 'object_name': 'QueuedMessage'},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'claimed_by': ('django.db.models.fields.CharField', [], {'max_length': '32', 'null': 'True', 'blank': 'True'}),
+            'claimed_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'context': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'from_email': ('django.db.models.fields.CharField', [], {'max_length': '254', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'next_attempt': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'recipients': ('emailtemplates.fields.SeparatedValuesField', [], {}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'queued'", 'max_length': '10'}),
+            'template': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['emailtemplates.EmailMessageTemplate']"})
+        }
+    }
+
+    complete_apps = ['emailtemplates']
\ No newline at end of file
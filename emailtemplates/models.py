@@ -1,11 +1,38 @@
-from django.db import models
+import hashlib
+import json
+import operator
+import time
+from collections import namedtuple
+from datetime import timedelta
+from email.mime.base import MIMEBase
+
+import django
+from django.db import models, connections, transaction
+from django.db.models.signals import post_save, post_delete
+from django.core.signals import request_finished
 from django.core.mail import EmailMultiAlternatives
+from django.core.exceptions import ValidationError
 from django.template import Context, Template
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
+from django.utils import timezone
 
 from conf import settings
-from fields import SeparatedValuesField, validate_template_syntax
+from fields import (SeparatedValuesField, validate_template_syntax,
+                    validate_template_context, compile_template,
+                    unique_addresses)
+from cache import (compiled_templates, validated_templates, source_key,
+                   template_registry, get_shared_version, get_shared_rows,
+                   set_shared_rows, bump_shared_version, flush_shared_version)
+from converters import html_to_text
+from background import run_in_background
+from signals import timed, record_cache_access, record_message
+from rendering import context_paths
+from precompiled import dump_templates, load_templates, load_template
+
+#: The rendered content of a template for one context
+RenderedMessage = namedtuple('RenderedMessage', ['subject', 'body', 'html'])
+
 
 class EmailMessageTemplateManager(models.Manager):
 
@@ -16,23 +43,218 @@ class EmailMessageTemplateManager(models.Manager):
         to retrieve a template with the specified name without a related object 
         instead (to support situations where some objects have a specialized 
         template, but, when none exists, we want to fall back to a default). 
+
+        Both candidates are fetched in a single query.
         """
-        if related_object:
-            object_id = related_object.pk
-            content_type = ContentType.objects.get_for_model(related_object)
-        else:
-            object_id = None
-            content_type = None
-        
-        try:
-            return self.get(name=name, object_id=object_id,
-                            content_type=content_type, enabled=True)
-        except EmailMessageTemplate.DoesNotExist:
-            if not related_object:
-                raise
-            return self.get(name=name, object_id=None, content_type=None,
-                            enabled=True)
+        return self.get_templates(name, [related_object])[0]
+
+    def get_templates(self, name, related_objects):
+        """
+        Bulk version of get_template.  Returns a list with the template to use 
+        for each of the related objects (None entries get the template without 
+        a related object), resolved with at most one query.  Each entry is a 
+        separate instance, even where objects share the fallback template.
+        """
+        with timed('lookup', name):
+            keys = []
+            for related_object in related_objects:
+                if related_object:
+                    content_type = ContentType.objects.get_for_model(
+                        related_object)
+                    keys.append((name, content_type.pk, related_object.pk))
+                else:
+                    keys.append(None)
+            default_key = (name, None, None)
+
+            rows = self._lookup_rows(name, keys, default_key)
+
+        templates = []
+        for key in keys:
+            row = rows.get(key) or rows.get(default_key)
+            if row is None:
+                raise self.model.DoesNotExist(
+                    "{0} matching query does not exist.".format(
+                        self.model._meta.object_name))
+            templates.append(self._from_row(row))
+        return templates
+
+    def _lookup_rows(self, name, keys, default_key):
+        """
+        Return a dictionary mapping (name, content type pk, object id) keys to 
+        the field values of the matching enabled template, or None.  Keys are 
+        looked up in the per-process template registry, then the shared 
+        template cache, and any still unknown are fetched from the database 
+        together, along with the default template if any object might need 
+        it.  Results, including misses, are stored in the enabled caches.
+        """
+        rows = {}
+        if settings.EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE > 0:
+            now = time.time()
+            wanted = self._wanted_keys(keys, default_key, rows)
+            for key in wanted:
+                entry = template_registry.get(key)
+                if entry is not None and entry[0] > now:
+                    rows[key] = entry[1]
+            record_cache_access('registry', name, len(rows),
+                                len(wanted) - len(rows))
+
+        missing = self._wanted_keys(keys, default_key, rows)
+        version = get_shared_version() if missing else None
+        if version is not None:
+            shared = get_shared_rows(missing, version)
+            rows.update(shared)
+            self._register_rows(shared)
+            record_cache_access('shared', name, len(shared),
+                                len(missing) - len(shared))
+
+        missing = self._wanted_keys(keys, default_key, rows)
+        if not missing:
+            return rows
+
+        object_ids = {}
+        for (_, content_type_id, object_id) in missing:
+            object_ids.setdefault(content_type_id, []).append(object_id)
+        conditions = []
+        for content_type_id, ids in object_ids.items():
+            if content_type_id is None:
+                conditions.append(models.Q(content_type__isnull=True,
+                                           object_id__isnull=True))
+            else:
+                conditions.append(models.Q(content_type=content_type_id,
+                                           object_id__in=ids))
+
+        attnames = self._row_fields()
+        content_type_index = attnames.index('content_type_id')
+        object_id_index = attnames.index('object_id')
+        found = {}
+        queryset = self.filter(reduce(operator.or_, conditions), name=name,
+                               enabled=True).order_by()
+        for row in queryset.values_list(*attnames):
+            found[(name, row[content_type_index], row[object_id_index])] = row
+
+        fetched = dict((key, found.get(key)) for key in missing)
+        rows.update(fetched)
+        self._register_rows(fetched, version)
+        return rows
+
+    def _register_rows(self, rows, version=None):
+        """
+        Store a dictionary of lookup keys to rows (or None for misses) in the 
+        template registry and, if the shared cache version read before the 
+        rows were fetched is given, the shared template cache.
+        """
+        if settings.EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE > 0:
+            expires = time.time() + settings.EMAILTEMPLATES_TEMPLATE_REGISTRY_TTL
+            for key, row in rows.items():
+                template_registry.set(key, (expires, row))
+        if version is not None:
+            set_shared_rows(rows, version)
+
+    def _wanted_keys(self, keys, default_key, rows):
+        """
+        The keys still needed to resolve templates for keys: object-specific 
+        keys not yet in rows, and the default key unless every object is known 
+        to have its own template.
+        """
+        wanted = set(key for key in keys if key and key not in rows)
+        if default_key not in rows and \
+                [key for key in keys if not rows.get(key)]:
+            wanted.add(default_key)
+        return wanted
+
+    def override_object_ids(self, name, model, enabled=True):
+        """
+        Return the ids of the objects of a model (given as a model class, an 
+        instance or a ContentType) that have their own template with the 
+        given name, in order.  Only enabled templates are included unless 
+        enabled is None.  The result is a lazy values_list queryset, and can 
+        be used in a filter, e.g. Site.objects.filter(pk__in=...).  On Django 
+        1.5 and later it is answered from the (name, content_type, object_id, 
+        enabled) index alone, without reading template rows.
+        """
+        if not isinstance(model, ContentType):
+            model = ContentType.objects.get_for_model(model)
+        queryset = self.filter(name=name, content_type=model)
+        if enabled is not None:
+            queryset = queryset.filter(enabled=enabled)
+        return queryset.order_by('object_id').values_list('object_id',
+                                                          flat=True)
+
+    def warm(self, names=None):
+        """
+        Load all enabled templates (or those with the given names), compile 
+        their subject and body templates and add them to the template 
+        registry and shared template cache, if enabled.  Returns a list of 
+        (template, seconds) pairs giving the time spent preparing each one.
+        """
+        queryset = self.filter(enabled=True).order_by()
+        if names is not None:
+            queryset = queryset.filter(name__in=names)
+
+        attnames = self._row_fields()
+        deferred = self.model.DEFERRED_FIELDS
+        version = get_shared_version()
+        rows = {}
+        timings = []
+        for row in queryset.values_list(*(attnames + list(deferred))):
+            start = time.time()
+            row, sources = row[:len(attnames)], row[len(attnames):]
+            template = self._from_row(row)
+            template.__dict__.update(zip(deferred, sources))
+            for field in self.model.TEMPLATE_FIELDS:
+                template.get_compiled_template(field)
+            rows[(template.name, template.content_type_id,
+                  template.object_id)] = row
+            timings.append((template, time.time() - start))
+        self._register_rows(rows, version)
+        return timings
+
+    def _row_fields(self):
+        """
+        The fields loaded by template lookups: all but DEFERRED_FIELDS.
+        """
+        return [f.attname for f in self.model._meta.fields
+                if f.attname not in self.model.DEFERRED_FIELDS]
+
+    def _from_row(self, row):
+        """
+        Build a template instance from a row of _row_fields values, as a 
+        queryset would.  The DEFERRED_FIELDS are left unset, to be loaded 
+        when first read (see DeferredField).
+        """
+        template = self.model(**dict(zip(self._row_fields(), row)))
+        for field in self.model.DEFERRED_FIELDS:
+            del template.__dict__[field]
+        template._state.adding = False
+        template._state.db = self.db
+        return template
+
 
+class DeferredField(object):
+    """
+    Descriptor for the fields template lookups leave out (see 
+    EmailMessageTemplate.DEFERRED_FIELDS).  Reading one that hasn't been 
+    loaded loads it from the database: the template sources and 
+    precompiled templates together, other fields on their own.  Unlike 
+    Django's defer(), this keeps lookups returning EmailMessageTemplate 
+    itself, so signal receivers connected for it still fire.
+    """
+
+    def __init__(self, attname):
+        self.attname = attname
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.attname not in instance.__dict__:
+            if self.attname in instance.SOURCE_FIELDS:
+                instance.load_template_sources()
+            else:
+                instance._load_fields([self.attname])
+        return instance.__dict__[self.attname]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.attname] = value
 
 class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
     """
@@ -42,6 +264,12 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
     
     CONTENT_TYPE_CHOICES = (('text/plain', 'Text',),
                             ('text/html', 'HTML',),)
+    TEMPLATE_FIELDS = ('subject_template', 'body_template', 'body_template_html')
+    #Large fields that template lookups leave out, to be loaded when needed
+    DEFERRED_FIELDS = ('body_template', 'body_template_html', 'description',
+                       'variable_index', 'precompiled')
+    #Fields needed to compile the template, loaded together
+    SOURCE_FIELDS = TEMPLATE_FIELDS + ('precompiled',)
 
     #Fields to identify a template
     name = models.CharField(max_length=50)
@@ -64,13 +292,15 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
     enabled = models.BooleanField(default=True, help_text="When unchecked, this email will not be sent.")
     edited_date = models.DateTimeField(auto_now=True, editable=False, blank=True)
     edited_user = models.TextField(max_length=30, editable=False, blank=True)
+    variable_index = models.TextField(editable=False, blank=True, help_text="The context variable paths used by each template field, encoded as JSON")
+    precompiled = models.TextField(editable=False, blank=True, help_text="The compiled template fields, if EMAILTEMPLATES_PRECOMPILE_TEMPLATES is set")
 
     objects = EmailMessageTemplateManager()
 
     #Ensure compatibility with EmailMessage CC, BCC, and from_email data
     _instance_to = []
-    _instance_cc = []
-    _instance_bcc = []
+    _instance_cc = ()
+    _instance_bcc = ()
     _instance_from = None
 
     @property
@@ -93,14 +323,20 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         The unique set of CC addresses specified either in the template or on 
         the instance.
         """
-        return list(set(self._instance_cc) | set(self.base_cc if self.base_cc is not None else []))
+        return list(self._addresses('cc')[1])
 
     @cc.setter
     def cc(self, value):
         """
         Add any addresses not in the template's CC list to the instance list.
         """
-        self._instance_cc = list(set(value) - set(self.base_cc if self.base_cc is not None else []))
+        if not value:
+            #Set by EmailMessage.__init__, before deferred fields can be loaded
+            self._instance_cc = ()
+            return
+        base = self._addresses('cc')[0]
+        self._instance_cc = tuple(address for address in unique_addresses(value)
+                                  if address not in base)
 
     @property
     def bcc(self):
@@ -108,14 +344,36 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         The unique set of BCC addresses specified either in the template or on 
         the instance.
         """
-        return list(set(self._instance_bcc) | set(self.base_bcc if self.base_bcc is not None else []))
+        return list(self._addresses('bcc')[1])
 
     @bcc.setter
     def bcc(self, value):
         """
         Add any addresses not in the template's BCC list to the instance list.
         """
-        self._instance_bcc = list(set(value) - set(self.base_cc if self.base_bcc is not None else []))
+        if not value:
+            self._instance_bcc = ()
+            return
+        base = self._addresses('bcc')[0]
+        self._instance_bcc = tuple(address for address in unique_addresses(value)
+                                   if address not in base)
+
+    def _addresses(self, kind):
+        """
+        Return the template's base addresses for kind ('cc' or 'bcc') as a 
+        frozenset, and a tuple of those addresses followed by the instance 
+        addresses.  Both are kept until the base field (compared as a tuple, 
+        to catch edits made in place) or the instance addresses change.
+        """
+        base = tuple(getattr(self, 'base_' + kind) or ())
+        instance = getattr(self, '_instance_' + kind)
+        cached = self.__dict__.get('_' + kind + '_addresses')
+        if cached is None or cached[0] != base or cached[1] is not instance:
+            unique = unique_addresses(base)
+            cached = (base, instance, frozenset(unique),
+                      tuple(unique) + instance)
+            self.__dict__['_' + kind + '_addresses'] = cached
+        return cached[2], cached[3]
 
     @property
     def from_email(self):
@@ -142,6 +400,9 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
 
     # Preparing and sending messages
     _context = Context({})
+    _rendered = None
+    _rendered_key = None
+    _context_snapshot = None
     subject_prefix = ""
 
     @property
@@ -154,10 +415,11 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
             self._context = value
         else:
             self._context = Context(value)
+        self._rendered = None
 
     @property
     def subject(self):
-        return self.subject_prefix + Template(self.subject_template).render(self.context)
+        return self.prepare().subject
 
     @subject.setter
     def subject(self, value):
@@ -168,13 +430,7 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
 
     @property
     def body(self):
-        if self.is_html_message() and self.autogenerate_text:
-            try:
-                import html2text
-                return html2text.html2text(self.html_content())
-            except ImportError:
-                pass
-        return Template(self.body_template).render(self.context)
+        return self.prepare().body
 
     @body.setter
     def body(self, value):
@@ -187,10 +443,282 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         """
         Render the HTML message content, if any
         """
-        if self.is_html_message():
-            return Template(self.body_template_html).render(self.context)
-        return None
+        return self.prepare().html
+
+    def prepare(self):
+        """
+        Render the subject, text body and HTML body against the current context 
+        and return them as a RenderedMessage.  The result is reused by later 
+        calls (and by the subject and body properties) until the context 
+        (including values set on it in place), the subject prefix or the 
+        template fields change.  Objects changed in place inside context 
+        values aren't detected, so send() always renders afresh.
+        """
+        if self._rendered is None or self._rendered_key != self._prepare_key() \
+                or self._context_changed():
+            self._rendered = self.render(self.context, self.subject_prefix)
+            #Rendering may load deferred fields, so the key is taken after
+            self._rendered_key = self._prepare_key()
+            self._context_snapshot = [(d, dict(d)) for d in self.context.dicts]
+        return self._rendered
+
+    def _context_changed(self):
+        """
+        Whether the context's dictionaries, or the values in them, have been 
+        replaced since the last render.  Values are compared by identity, 
+        and the snapshot holds references to them so that ids aren't reused.
+        """
+        dicts = self.context.dicts
+        snapshot = self._context_snapshot
+        if snapshot is None or len(snapshot) != len(dicts):
+            return True
+        for d, (original, values) in zip(dicts, snapshot):
+            if d is not original or len(d) != len(values):
+                return True
+            for key, value in d.iteritems():
+                if key not in values or values[key] is not value:
+                    return True
+        return False
+
+    def _prepare_key(self):
+        """
+        The values prepare's result depends on, besides the context.  Template 
+        fields that haven't been loaded can't have been changed, so they are 
+        left out rather than loaded.
+        """
+        deferred = self.get_deferred_fields()
+        return (self.subject_prefix, self.autogenerate_text,
+                self.is_html_message()) + \
+            tuple(None if field in deferred else getattr(self, field)
+                  for field in self.TEMPLATE_FIELDS)
+
+    def render(self, context, subject_prefix="", templates=None):
+        """
+        Render the template against a context without storing the result on 
+        the instance.  templates may map field names to objects to render in 
+        place of the fields' compiled templates, such as the 
+        SegmentedTemplates used for bulk sends.
+        """
+        def compiled(field):
+            if templates and field in templates:
+                return templates[field]
+            return self.get_compiled_template(field)
+
+        with timed('render', self.name):
+            html = None
+            if self.is_html_message():
+                html = compiled('body_template_html').render(context)
+
+            body = None
+            if html is not None and self.autogenerate_text:
+                with timed('convert', self.name):
+                    body = html_to_text(html, self.name)
+            if body is None:
+                body = compiled('body_template').render(context)
+
+            subject = subject_prefix + \
+                compiled('subject_template').render(context)
+        return RenderedMessage(subject, body, html)
+
+    def get_compiled_template(self, field):
+        """
+        Return a compiled Template for one of the template source fields.  
+        Compiled templates for saved instances are shared through a 
+        process-wide LRU cache keyed by pk, field and edited_date, so each 
+        template version is only parsed once, and a cache hit for a field 
+        deferred by the lookup doesn't need to load its source.  Templates 
+        compiled when the field was validated are reused, and otherwise the 
+        compiled template stored with the template is loaded, if it is 
+        current, before falling back to parsing the source.
+        """
+        if self.pk is None:
+            return Template(getattr(self, field))
+
+        key = (self.pk, field, self.edited_date)
+        cached = compiled_templates.get(key)
+        #Guard against unsaved edits to the source on this instance
+        if cached is not None and (field in self.get_deferred_fields() or
+                                   cached[0] == getattr(self, field)):
+            record_cache_access('compiled', self.name, hits=1)
+            return cached[1]
+        record_cache_access('compiled', self.name, misses=1)
+        self.load_template_sources()
+        source = getattr(self, field)
+        template = validated_templates.get(source_key(source))
+        if template is None:
+            template = self._load_precompiled(field, source)
+        if template is None:
+            with timed('compile', self.name):
+                template = Template(source)
+        compiled_templates.set(key, (source, template))
+        return template
     
+    def get_deferred_fields(self):
+        """
+        Return the set of fields deferred by the lookup or query that loaded 
+        this template, and not loaded since.
+        """
+        return set(field.attname for field in self._meta.fields
+                   if field.attname not in self.__dict__)
+
+    def load_template_sources(self):
+        """
+        Load any deferred template fields and precompiled templates, together 
+        in one query, so that the template can be compiled (or sent to 
+        another process) without further queries.
+        """
+        deferred = self.get_deferred_fields()
+        self._load_fields([field for field in self.SOURCE_FIELDS
+                           if field in deferred])
+
+    def _load_fields(self, fields):
+        if fields:
+            values = EmailMessageTemplate._default_manager\
+                .using(self._state.db).filter(pk=self.pk)\
+                .values_list(*fields).get()
+            self.__dict__.update(zip(fields, values))
+
+    def save(self, *args, **kwargs):
+        self.update_variable_index()
+        self.update_precompiled()
+        super(EmailMessageTemplate, self).save(*args, **kwargs)
+
+    def update_precompiled(self):
+        """
+        Store the compiled template fields in the precompiled field if 
+        EMAILTEMPLATES_PRECOMPILE_TEMPLATES is set, or clear it otherwise.  
+        This is done by save(), but must be called before saving by other 
+        means, such as bulk_create.
+        """
+        templates = {}
+        if settings.EMAILTEMPLATES_PRECOMPILE_TEMPLATES:
+            for field in self.TEMPLATE_FIELDS:
+                source = getattr(self, field) or ''
+                try:
+                    templates[field] = (source, compile_template(source))
+                except ValidationError:
+                    continue
+        self.precompiled = dump_templates(templates)
+
+    def _load_precompiled(self, field, source):
+        """
+        Return the stored compiled template for a field if it was compiled 
+        from source by a compatible version, or None.
+        """
+        value = self.precompiled
+        if not value:
+            return None
+        cached = self.__dict__.get('_precompiled_cache')
+        if cached is None or cached[0] is not value:
+            cached = (value, load_templates(value))
+            self._precompiled_cache = cached
+        template = load_template(cached[1], field, source)
+        record_cache_access('precompiled', self.name,
+                            hits=int(template is not None),
+                            misses=int(template is None))
+        return template
+
+    def update_variable_index(self, index=None):
+        """
+        Store the variable index (built from the current fields, unless given) 
+        in the variable_index field.  This is done by save(), but must be 
+        called before saving by other means, such as bulk_create.
+        """
+        if index is None:
+            index = self.build_variable_index()
+        self.variable_index = json.dumps({
+                'checksum': self._sources_checksum(),
+                'fields': index}, sort_keys=True)
+
+    def build_variable_index(self):
+        """
+        Return a dictionary mapping each template field to a sorted list of 
+        the variable paths (such as 'user.email') it looks up in the context.  
+        Fields with syntax errors are left out.
+        """
+        index = {}
+        for field in self.TEMPLATE_FIELDS:
+            try:
+                template = compile_template(getattr(self, field) or '')
+            except ValidationError:
+                continue
+            index[field] = sorted(context_paths(template.nodelist))
+        return index
+
+    def variable_paths(self, fields=None):
+        """
+        Return the set of context variable paths used by the given template 
+        fields (all of them by default), from the index stored when the 
+        template was saved.  The index is rebuilt if the fields have changed 
+        since.
+        """
+        index = self._variable_index()
+        paths = set()
+        for field in fields or self.TEMPLATE_FIELDS:
+            paths.update(index.get(field, ()))
+        return paths
+
+    def context_names(self, fields=None):
+        """
+        Return the set of top-level context names used by the given template 
+        fields (all of them by default).  Values for other names are never 
+        looked up when the template is rendered, so a caller can skip 
+        building them.
+        """
+        return set(path.split('.', 1)[0]
+                   for path in self.variable_paths(fields))
+
+    def validate_context(self, context):
+        """
+        Ensure a context provides every top-level name the template uses.
+        """
+        if isinstance(context, Context):
+            provided = set()
+            for d in context.dicts:
+                provided.update(d)
+        else:
+            provided = set(context)
+        missing = self.context_names() - provided
+        if missing:
+            raise ValidationError("Missing context variables: " +
+                                  ", ".join(sorted(missing)))
+
+    def _variable_index(self):
+        checksum = self._sources_checksum()
+        cached = self.__dict__.get('_variable_index_cache')
+        if cached is not None and cached[0] == checksum:
+            return cached[1]
+        stored = json.loads(self.variable_index or '{}')
+        if stored.get('checksum') == checksum:
+            index = stored['fields']
+        else:
+            index = self.build_variable_index()
+        self._variable_index_cache = (checksum, index)
+        return index
+
+    def _sources_checksum(self):
+        self.load_template_sources()
+        digest = hashlib.sha1()
+        for field in self.TEMPLATE_FIELDS:
+            digest.update(source_key(getattr(self, field) or ''))
+        return digest.hexdigest()
+
+    def clean(self):
+        """
+        Check the template fields against the context schema declared for 
+        this template's name in EMAILTEMPLATES_CONTEXT_SCHEMAS, if any.
+        """
+        names = settings.EMAILTEMPLATES_CONTEXT_SCHEMAS.get(self.name)
+        if names is None:
+            return
+        for field in self.TEMPLATE_FIELDS:
+            try:
+                validate_template_context(getattr(self, field) or '', names)
+            except ValidationError as e:
+                raise ValidationError(u"{0}: {1}".format(
+                        self._meta.get_field(field).verbose_name.capitalize(),
+                        u" ".join(e.messages)))
+
     def is_html_message(self):
         return settings.EMAILTEMPLATES_ALLOW_HTML_MESSAGES \
             and self.type == 'text/html'
@@ -203,10 +731,14 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         result = None
         send_error = None
         try:
-            html_content = self.html_content()
+            #Render afresh, in case context values were changed in place
+            self._rendered = None
+            html_content = self.prepare().html
             if html_content is not None:
                 self.attach_alternative(html_content, "text/html")
-            result = super(EmailMessageTemplate, self).send(fail_silently=False)
+            with timed('send', self.name):
+                result = super(EmailMessageTemplate, self).send(
+                    fail_silently=False)
         except Exception as e:
             raise
             send_error = e
@@ -217,6 +749,33 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
 
         return result
     
+    def message(self):
+        with timed('mime', self.name):
+            message = super(EmailMessageTemplate, self).message()
+        record_message(message, self.name)
+        return message
+
+    def send_async(self, fail_silently=False):
+        """
+        Sends the email message in the background send pool.  Returns an 
+        AsyncResult, whose get() method waits for and returns the result of 
+        send(), or raises its exception.  The message should not be changed 
+        until it has been sent.
+        """
+        self.load_template_sources()
+        return run_in_background(self.send, fail_silently)
+
+    def encoded_attachments(self, attachments=()):
+        """
+        Return the template's attachments, followed by any additional 
+        attachments given (as MIMEBase objects or (filename, content, 
+        mimetype) tuples), as encoded MIME parts.  The parts can be shared by 
+        every message in a bulk send, so each attachment is encoded once.
+        """
+        return [attachment if isinstance(attachment, MIMEBase)
+                else self._create_attachment(*attachment)
+                for attachment in list(self.attachments) + list(attachments)]
+
     def related_item_display(self):
         return unicode(self.related_object) if self.related_object else 'None'
     related_item_display.short_description = "Related Item"
@@ -234,4 +793,175 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
     class Meta:
         ordering = ('name',)
         unique_together = (("name", "content_type", "object_id"),)
+        if django.VERSION >= (1, 5):
+            #Covers override_object_ids; get_template lookups use it to find
+            #their rows, but still read the other columns
+            index_together = (("name", "content_type", "object_id", "enabled"),)
         verbose_name = "Email Template"
+
+
+for attname in EmailMessageTemplate.DEFERRED_FIELDS:
+    setattr(EmailMessageTemplate, attname, DeferredField(attname))
+
+
+class TemplatedMessage(EmailMultiAlternatives):
+    """
+    A message rendered from an EmailMessageTemplate for a single context and 
+    recipient list.  Unlike a copy of the template itself, it shares the 
+    template (and its compiled templates) and only holds its own rendered 
+    content and addresses, so it is cheap to build in bulk.
+    """
+
+    def __init__(self, template, context=None, from_email=None, to=None,
+                 connection=None, rendered=None, attachments=None):
+        """
+        Render the template against context, unless the RenderedMessage for 
+        that context has already been produced elsewhere and is passed in as 
+        rendered.  If attachments is given, it replaces the template's own 
+        attachments (see EmailMessageTemplate.encoded_attachments).
+        """
+        if attachments is None:
+            attachments = template.attachments
+        if rendered is None:
+            if not isinstance(context, Context):
+                context = Context(context or {})
+            rendered = template.render(context, template.subject_prefix)
+        super(TemplatedMessage, self).__init__(
+            subject=rendered.subject, body=rendered.body,
+            from_email=from_email or template.from_email, to=to,
+            cc=template.cc, bcc=template.bcc, connection=connection,
+            attachments=list(attachments),
+            headers=dict(template.extra_headers))
+        if rendered.html is not None:
+            self.attach_alternative(rendered.html, "text/html")
+        self.template = template
+
+    def message(self):
+        with timed('mime', self.template.name):
+            message = super(TemplatedMessage, self).message()
+        record_message(message, self.template.name)
+        return message
+
+
+class QueuedMessageManager(models.Manager):
+
+    def claim(self, limit, token, lease):
+        """
+        Mark up to limit messages that are due to be sent as claimed by token, 
+        and return them.  Messages claimed more than lease seconds ago are 
+        assumed to belong to a worker that died, and may be claimed again.
+
+        On PostgreSQL, due messages are selected with FOR UPDATE SKIP LOCKED, 
+        so concurrent workers never wait for each other.  Other databases 
+        select candidate messages and claim them with a conditional UPDATE, so 
+        each message is still only claimed by one worker.
+        """
+        now = timezone.now()
+        expired = now - timedelta(seconds=lease)
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql' and \
+                getattr(connection, 'pg_version', 0) >= 90500:
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE {0} SET claimed_by = %s, claimed_date = %s "
+                "WHERE id IN (SELECT id FROM {0} "
+                "WHERE status = %s AND next_attempt <= %s "
+                "AND (claimed_by IS NULL OR claimed_date < %s) "
+                "ORDER BY next_attempt LIMIT %s "
+                "FOR UPDATE SKIP LOCKED)".format(table),
+                [token, now, self.model.QUEUED, now, expired, limit])
+            if not hasattr(transaction, 'atomic'):
+                transaction.commit_unless_managed(using=self.db)
+        else:
+            available = self.filter(
+                models.Q(claimed_by__isnull=True) |
+                models.Q(claimed_date__lt=expired),
+                status=self.model.QUEUED, next_attempt__lte=now)
+            ids = list(available.order_by('next_attempt')
+                       .values_list('pk', flat=True)[:limit])
+            if not ids:
+                return []
+            available.filter(pk__in=ids).update(claimed_by=token,
+                                                claimed_date=now)
+        return list(self.filter(claimed_by=token, claimed_date=now,
+                                status=self.model.QUEUED)
+                    .select_related('template'))
+
+
+class QueuedMessage(models.Model):
+    """
+    A message waiting to be sent by the run_emailtemplates_worker command.  
+    Messages are deleted once they have been sent.
+    """
+    QUEUED = 'queued'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, 'Queued'),
+                      (FAILED, 'Failed'),)
+
+    template = models.ForeignKey(EmailMessageTemplate)
+    context = models.TextField(blank=True, help_text="The template context, encoded as JSON")
+    from_email = models.CharField(max_length=254, blank=True)
+    recipients = SeparatedValuesField(token='\n')
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    created_date = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=32, null=True, blank=True)
+    claimed_date = models.DateTimeField(null=True, blank=True)
+
+    objects = QueuedMessageManager()
+
+    def __unicode__(self):
+        return u"{0} to {1}".format(self.template.name,
+                                    u", ".join(self.recipients or []))
+
+    class Meta:
+        ordering = ('next_attempt',)
+
+
+def connect_template_handler(handler):
+    """
+    Call handler when a template is saved or deleted.  Templates loaded with 
+    only() or defer() are instances of a deferred subclass, which Django 
+    sends as the signals' sender, so the handler is connected for every 
+    sender and only called for templates.
+    """
+    def receiver(sender, instance, **kwargs):
+        if isinstance(instance, EmailMessageTemplate):
+            handler(sender, instance, **kwargs)
+    post_save.connect(receiver, weak=False)
+    post_delete.connect(receiver, weak=False)
+
+
+def invalidate_compiled_templates(sender, instance, **kwargs):
+    """
+    Discard any compiled templates cached for a template that has been saved 
+    or deleted.
+    """
+    compiled_templates.delete_matching(lambda key: key[0] == instance.pk)
+
+connect_template_handler(invalidate_compiled_templates)
+
+
+def invalidate_template_registry(sender, instance, **kwargs):
+    """
+    Forget all registered template lookups when any template is saved or 
+    deleted, since the change may affect hits and misses for other keys.
+    """
+    template_registry.clear()
+
+connect_template_handler(invalidate_template_registry)
+
+
+def invalidate_shared_template_cache(sender, instance, **kwargs):
+    """
+    Retire all template rows in the shared cache when any template is saved 
+    or deleted, and again once the change is committed.
+    """
+    bump_shared_version(kwargs.get('using'))
+
+connect_template_handler(invalidate_shared_template_cache)
+request_finished.connect(flush_shared_version)
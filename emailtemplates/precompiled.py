@@ -0,0 +1,122 @@
+"""
+Storage of compiled templates in the database, so that new processes can
+load a template's node tree instead of parsing its source
+
+Compiled templates are pickled, compressed and signed with the SECRET_KEY,
+along with a hash of the source each was compiled from.  The stored form is
+tagged with a version covering the pickle format, the Python and Django
+versions and the installed template tag libraries, and is ignored (so the
+template is compiled from source as usual) when any of these differ.
+
+Only templates made entirely of Django's own nodes are stored.  Nodes from
+custom tag libraries can change between deploys without changing the
+version, and constant includes load the included template when parsed, so
+templates containing either are always compiled from source.
+"""
+import base64
+import cPickle as pickle
+import hashlib
+import sys
+import zlib
+
+import django
+from django.template.base import Node, get_templatetags_modules
+from django.template.loader_tags import ConstantIncludeNode
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from cache import source_key
+
+#Bumped when the stored format changes
+FORMAT_VERSION = 1
+
+_SALT = 'emailtemplates.precompiled'
+_version = None
+
+#Modules whose nodes are covered by the Django version in the version tag
+_BUILTIN_MODULES = ('django.template.', 'django.templatetags.')
+
+
+def precompiled_version():
+    """
+    Return the version tag for compiled templates stored by this process.
+    """
+    global _version
+    if _version is None:
+        parts = [str(FORMAT_VERSION), django.get_version(),
+                 '.'.join(str(part) for part in sys.version_info[:2])]
+        parts.extend(get_templatetags_modules())
+        _version = hashlib.sha1('\n'.join(parts)).hexdigest()[:16]
+    return _version
+
+
+def storable(template):
+    """
+    Return whether a compiled template can be stored, that is, whether it
+    only contains nodes defined by Django and no constant includes.
+    """
+    for node in template.nodelist.get_nodes_by_type(Node):
+        if (isinstance(node, ConstantIncludeNode) or
+                not type(node).__module__.startswith(_BUILTIN_MODULES)):
+            return False
+    return True
+
+
+def dump_templates(templates):
+    """
+    Given a dictionary mapping field names to (source, compiled Template)
+    pairs, return the stored form of the compiled templates.  Templates that
+    can't be stored (see storable) or pickled are left out, and compiled
+    from source when loaded.
+    """
+    fields = {}
+    for field, (source, template) in templates.items():
+        if not storable(template):
+            continue
+        try:
+            fields[field] = (source_key(source),
+                             pickle.dumps(template, pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            continue
+    if not fields:
+        return ''
+    data = zlib.compress(pickle.dumps(fields, pickle.HIGHEST_PROTOCOL))
+    signature = salted_hmac(_SALT, data).hexdigest()
+    return ':'.join([precompiled_version(), signature,
+                     base64.b64encode(data)])
+
+
+def load_templates(value):
+    """
+    Return a dictionary mapping field names to (source key, pickled Template)
+    pairs from a stored value, or an empty dictionary if it is empty, was
+    stored by a different version or fails its signature check.
+    """
+    try:
+        version, signature, data = value.split(':', 2)
+    except ValueError:
+        return {}
+    if version != precompiled_version():
+        return {}
+    data = base64.b64decode(data)
+    if not constant_time_compare(signature,
+                                 salted_hmac(_SALT, data).hexdigest()):
+        return {}
+    return pickle.loads(zlib.decompress(data))
+
+
+def load_template(fields, field, source):
+    """
+    Unpickle the compiled template for a field, from the result of
+    load_templates, if it was compiled from source.  Returns None if it
+    wasn't, or can't be loaded.
+    """
+    if field not in fields:
+        return None
+    key, data = fields[field]
+    if key != source_key(source):
+        return None
+    try:
+        return pickle.loads(data)
+    except Exception:
+        #Stored by code that has since changed; compile from source instead
+        return None
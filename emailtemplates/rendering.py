@@ -0,0 +1,250 @@
+"""
+Rendering of bulk messages: segmented templates whose static parts are 
+rendered once per campaign, and pools of worker processes or threads
+"""
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from django.template import Context, defaulttags
+from django.template.base import (Node, NodeList, TextNode, VariableNode,
+                                  Variable, FilterExpression)
+from django.template.smartif import TokenBase
+from django.utils.encoding import force_unicode
+from django.utils.safestring import mark_safe
+
+#Built-in nodes whose output depends only on the variables they reference
+STATELESS_NODES = tuple([TextNode, VariableNode] + [
+    getattr(defaulttags, name) for name in (
+        'AutoEscapeControlNode', 'CommentNode', 'FilterNode', 'FirstOfNode',
+        'ForNode', 'IfEqualNode', 'IfNode', 'LoadNode', 'SpacelessNode',
+        'TemplateTagNode', 'VerbatimNode', 'WidthRatioNode', 'WithNode')
+    if hasattr(defaulttags, name)])
+
+
+class _Dynamic(Exception):
+    pass
+
+
+def referenced_names(node):
+    """
+    Return the set of top-level context names referenced by a node and its 
+    children.  Raises _Dynamic if the node (or a child) isn't a built-in 
+    node whose output is known to depend only on those names.
+    """
+    names = set()
+    _collect_names(node, names)
+    return names
+
+
+def _collect_names(obj, names):
+    if isinstance(obj, Variable):
+        if obj.lookups:
+            names.add(obj.lookups[0])
+    elif isinstance(obj, FilterExpression):
+        _collect_names(obj.var, names)
+        for func, args in obj.filters:
+            for lookup, arg in args:
+                _collect_names(arg, names)
+    elif isinstance(obj, Node):
+        if type(obj) not in STATELESS_NODES:
+            raise _Dynamic
+        for value in vars(obj).values():
+            _collect_names(value, names)
+    elif isinstance(obj, TokenBase):
+        for value in vars(obj).values():
+            _collect_names(value, names)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _collect_names(value, names)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _collect_names(value, names)
+
+
+def context_names(node):
+    """
+    Return the set of names a node and its children look up in the context 
+    they're rendered with, leaving out names bound by {% for %} and 
+    {% with %} tags inside the node.  Unlike referenced_names, any node is 
+    accepted, but names used by custom tags that don't store them as 
+    variables, or by included templates, aren't found.
+    """
+    return set(path.split('.', 1)[0] for path in context_paths(node))
+
+
+def context_paths(node):
+    """
+    Return the set of variable paths (such as 'user.email') a node and its 
+    children look up in the context, as for context_names.
+    """
+    paths = set()
+    _collect_context_paths(node, paths, frozenset())
+    return paths
+
+
+def _collect_context_paths(obj, paths, bound):
+    if isinstance(obj, Variable):
+        if obj.lookups and obj.lookups[0] not in bound:
+            paths.add('.'.join(obj.lookups))
+    elif isinstance(obj, FilterExpression):
+        _collect_context_paths(obj.var, paths, bound)
+        for func, args in obj.filters:
+            for lookup, arg in args:
+                _collect_context_paths(arg, paths, bound)
+    elif isinstance(obj, defaulttags.ForNode):
+        _collect_context_paths(obj.sequence, paths, bound)
+        _collect_context_paths(obj.nodelist_loop, paths,
+                               bound | set(obj.loopvars) | set(['forloop']))
+        _collect_context_paths(obj.nodelist_empty, paths, bound)
+    elif isinstance(obj, defaulttags.WithNode) and \
+            hasattr(obj, 'extra_context'):
+        _collect_context_paths(obj.extra_context, paths, bound)
+        _collect_context_paths(obj.nodelist, paths,
+                               bound | set(obj.extra_context))
+    elif isinstance(obj, (Node, TokenBase)):
+        for value in vars(obj).values():
+            _collect_context_paths(value, paths, bound)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _collect_context_paths(value, paths, bound)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _collect_context_paths(value, paths, bound)
+
+
+class SegmentedTemplate(object):
+    """
+    Wraps a compiled template for a campaign in which only some context keys 
+    (recipient_keys) differ between recipients.
+
+    The template's top-level nodes are split into runs of static nodes, which 
+    reference none of the recipient keys, and dynamic nodes.  The first render 
+    renders everything and keeps the output of the static runs; later renders 
+    only render the dynamic runs.  Context values other than the recipient 
+    keys must therefore be the same for every render.  Nodes other than 
+    simple built-in tags are always treated as dynamic.
+    """
+
+    def __init__(self, template, recipient_keys):
+        recipient_keys = set(recipient_keys)
+        self.segments = []
+        for node in template.nodelist:
+            try:
+                dynamic = bool(referenced_names(node) & recipient_keys)
+            except _Dynamic:
+                dynamic = True
+            if self.segments and self.segments[-1][0] == dynamic:
+                self.segments[-1][1].append(node)
+            else:
+                self.segments.append((dynamic, NodeList([node])))
+        self._static = None
+
+    def render(self, context):
+        context.render_context.push()
+        try:
+            if self._static is None:
+                bits = [force_unicode(nodes.render(context))
+                        for dynamic, nodes in self.segments]
+                self._static = [None if dynamic else bit
+                                for bit, (dynamic, nodes)
+                                in zip(bits, self.segments)]
+            else:
+                bits = [force_unicode(nodes.render(context)) if dynamic
+                        else static for static, (dynamic, nodes)
+                        in zip(self._static, self.segments)]
+        finally:
+            context.render_context.pop()
+        return mark_safe(u''.join(bits))
+
+
+def segment_templates(template, recipient_keys):
+    """
+    Return a dictionary of SegmentedTemplates for each of an 
+    EmailMessageTemplate's template fields, for use with its render method.
+    """
+    return dict((field, SegmentedTemplate(
+                    template.get_compiled_template(field), recipient_keys))
+                for field in template.TEMPLATE_FIELDS)
+
+#The template (and segmented templates, if any) shipped to a worker process
+#when its pool starts
+_template = None
+_templates = None
+
+
+def render_context(template, context, templates=None):
+    """
+    Render a template against a context (or plain dictionary) and return the 
+    RenderedMessage.  templates is passed on to the template's render method.
+    """
+    if not isinstance(context, Context):
+        context = Context(context or {})
+    return template.render(context, template.subject_prefix, templates)
+
+
+def _initialize_worker(template, recipient_keys):
+    global _template, _templates
+    _template = template
+    _templates = None
+    if recipient_keys:
+        _templates = segment_templates(template, recipient_keys)
+
+
+def _render_in_worker(context):
+    return render_context(_template, context, _templates)
+
+
+class RenderPool(object):
+    """
+    Renders contexts for one template in a pool of worker processes or 
+    threads.
+
+    The template is compiled before the pool starts and handed to each 
+    worker once, when it starts, rather than with every message.  Contexts 
+    rendered in a process pool must be picklable and should not need 
+    database access.  If recipient_keys is given, workers render through 
+    SegmentedTemplates.
+    """
+
+    def __init__(self, template, workers, kind='process', recipient_keys=None):
+        for field in template.TEMPLATE_FIELDS:
+            template.get_compiled_template(field)
+
+        if kind == 'process':
+            #Workers mustn't share the parent's database connection
+            template.load_template_sources()
+            self._pool = Pool(workers, _initialize_worker,
+                              (template, recipient_keys))
+            self._render = _render_in_worker
+        elif kind == 'thread':
+            self._pool = ThreadPool(workers)
+            templates = None
+            if recipient_keys:
+                templates = segment_templates(template, recipient_keys)
+            self._render = partial(render_context, template,
+                                   templates=templates)
+        else:
+            raise ValueError("Unknown render pool type: {0}".format(kind))
+
+    def render_chunks(self, chunks):
+        """
+        Given an iterable of chunks of (context, from_email, recipient_list) 
+        tuples, yield (chunk, rendered) pairs in the original order, where 
+        rendered is the list of RenderedMessages for the chunk.  The next chunk 
+        is rendered while the caller handles the current one, so at most two 
+        chunks are held in memory.
+        """
+        pending = None
+        for chunk in chunks:
+            result = self._pool.map_async(self._render,
+                                          [entry[0] for entry in chunk])
+            if pending is not None:
+                yield pending[0], pending[1].get()
+            pending = (chunk, result)
+        if pending is not None:
+            yield pending[0], pending[1].get()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
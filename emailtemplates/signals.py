@@ -0,0 +1,70 @@
+"""
+Signals reporting how long each phase of preparing and sending a message
+takes, how well the template caches are working and how large messages are
+
+Each signal is only sent (and timings are only taken) while it has
+receivers, so the instrumentation costs almost nothing when unused.  Every
+signal is sent with sender=None and a template_name argument, which is None
+where the template isn't known.
+"""
+import time
+
+from django.dispatch import Signal
+
+#: Sent after each instrumented phase, with the phase name and its duration
+#: in seconds.  Phases are 'lookup' (finding templates), 'compile' (parsing
+#: a template field), 'render' (rendering a message, including 'convert'),
+#: 'convert' (autogenerating text from HTML), 'mime' (building the MIME
+#: message) and 'send' (delivering one or more messages, including 'mime').
+phase_timed = Signal(providing_args=['template_name', 'phase', 'duration'])
+
+#: Sent after the caches are consulted, with the cache name ('registry',
+#: 'shared', 'compiled', 'precompiled' or 'conversion') and the number of
+#: hits and misses.
+cache_accessed = Signal(providing_args=['template_name', 'cache', 'hits',
+                                        'misses'])
+
+#: Sent when a message is built, with its size in bytes
+message_built = Signal(providing_args=['template_name', 'size'])
+
+
+class timed(object):
+    """
+    Context manager that sends phase_timed for the code it wraps, if the
+    signal has receivers.
+    """
+    __slots__ = ('phase', 'template_name', 'start')
+
+    def __init__(self, phase, template_name):
+        self.phase = phase
+        self.template_name = template_name
+        self.start = None
+
+    def __enter__(self):
+        if phase_timed.receivers:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            phase_timed.send(sender=None, template_name=self.template_name,
+                             phase=self.phase,
+                             duration=time.time() - self.start)
+
+
+def record_cache_access(cache, template_name, hits=0, misses=0):
+    """
+    Send cache_accessed, if it has receivers and the cache was consulted.
+    """
+    if cache_accessed.receivers and (hits or misses):
+        cache_accessed.send(sender=None, template_name=template_name,
+                            cache=cache, hits=hits, misses=misses)
+
+
+def record_message(message, template_name):
+    """
+    Send message_built for a MIME message, if the signal has receivers.
+    """
+    if message_built.receivers:
+        message_built.send(sender=None, template_name=template_name,
+                           size=len(message.as_string()))
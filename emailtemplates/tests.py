@@ -1,17 +1,50 @@
+import asyncore
+import copy
+import os
+import shutil
+import smtpd
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+from email import encoders
+from StringIO import StringIO
 from datetime import datetime, timedelta
 
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core import mail
+from django.core.mail import message as message_module
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.locmem import EmailBackend as LocmemBackend
 from django.test import TestCase
 from django.contrib.sites.models import Site
+from django.db.models.signals import post_save
 from django.contrib.contenttypes.models import ContentType
-from django.template import Context
+from django.template import Context, Template, Node, Library
+from django.template.base import builtins
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.utils import timezone
 
-from models import EmailMessageTemplate
-from fields import validate_template_syntax
-from utils import send_mail, send_mass_mail, mail_admins, mail_managers
+import converters
+from models import EmailMessageTemplate, TemplatedMessage, QueuedMessage
+from fields import validate_template_syntax, validate_template_context
+from converters import Html2TextConverter, SimpleTextConverter
+from rendering import SegmentedTemplate, context_names
+from utils import (send_mail, send_mass_mail, iter_send_mass_mail, mail_admins,
+                   mail_managers, send_mail_async, send_mass_mail_async)
+from backends import ConcurrentSMTPBackend
+from connections import connection_pool, pooled_connection
+from mailqueue import process_queue
+from signals import phase_timed, cache_accessed, message_built
+from transfer import export_templates, import_templates, TemplateImportError
+import cache
+from cache import (LRUCache, compiled_templates, validated_templates,
+                   source_key, template_registry, text_conversions,
+                   get_shared_cache, get_shared_version, get_shared_rows,
+                   set_shared_rows, bump_shared_version)
 
 class TemplateRetrievalTest(TestCase):
     """
@@ -73,6 +106,48 @@ class TemplateRetrievalTest(TestCase):
         self.assertEqual(template.pk, 2)
 
 
+    # Resolution in a single query
+    def test_retrieve_object_template_single_query(self):
+        """Ensure the object and fallback templates are fetched together"""
+        site = Site.objects.get(pk=2)
+        ContentType.objects.get_for_model(site)
+        with self.assertNumQueries(1):
+            template = EmailMessageTemplate.objects.get_template("Template 1",
+                                                                 site)
+        self.assertEqual(template.pk, 1)
+
+    def test_retrieve_templates_bulk(self):
+        """Ensure templates for several objects are resolved in one query"""
+        sites = list(Site.objects.order_by('pk'))
+        ContentType.objects.get_for_model(sites[0])
+        with self.assertNumQueries(1):
+            templates = EmailMessageTemplate.objects.get_templates(
+                "Template 1", sites + [None])
+        self.assertEqual([t.pk for t in templates], [4, 1, 1])
+        self.assertFalse(templates[1] is templates[2])
+
+    def test_retrieve_templates_bulk_missing(self):
+        """Ensure an exception is raised if any object has no template"""
+        sites = list(Site.objects.order_by('pk'))
+        self.assertRaises(EmailMessageTemplate.DoesNotExist,
+            lambda: EmailMessageTemplate.objects.get_templates(
+                "Nonexistent Template", sites))
+
+    def test_override_object_ids(self):
+        """Ensure the objects with their own templates are listed"""
+        manager = EmailMessageTemplate.objects
+        self.assertEqual(list(manager.override_object_ids("Template 1", Site)),
+                         [1])
+        self.assertEqual(list(manager.override_object_ids("Template 2", Site)),
+                         [])
+        content_type = ContentType.objects.get_for_model(Site)
+        self.assertEqual(list(manager.override_object_ids(
+                    "Template 2", content_type, enabled=None)), [2])
+        with self.assertNumQueries(1):
+            sites = list(Site.objects.filter(
+                    pk__in=manager.override_object_ids("Template 1", Site)))
+        self.assertEqual([site.pk for site in sites], [1])
+
 class TemplatePreparationTest(TestCase):
     """
     Ensure that template data is correctly produced when a template is 
@@ -180,6 +255,44 @@ class TemplatePreparationTest(TestCase):
         bcc.sort()
         self.assertEqual(bcc, ['c@example.com', 'd@example.com',
                                'inprepare2@example.com', 'inprepare@example.com'])
+
+    def test_bcc_excludes_template_bcc(self):
+        """
+        Ensure instance BCC addresses are checked against the template's BCC 
+        list, not its CC list
+        """
+        template = EmailMessageTemplate.objects.get_template("Template 2")
+        template.bcc = ['a@example.com', 'c@example.com']
+        bcc = template.bcc
+        bcc.sort()
+        self.assertEqual(bcc, ['a@example.com', 'c@example.com',
+                               'd@example.com'])
+
+    def test_addresses_normalized(self):
+        """Ensure addresses are stripped and duplicates dropped"""
+        template = EmailMessageTemplate.objects.get_template("Template 2")
+        template.base_cc = ' a@example.com, ,b@example.com,a@example.com'
+        template.cc = [' e@example.com', 'e@example.com ', 'b@example.com']
+        self.assertEqual(template.cc, ['a@example.com', 'b@example.com',
+                                       'e@example.com'])
+
+    def test_addresses_memoized(self):
+        """Ensure merged address lists are reused until they change"""
+        template = EmailMessageTemplate.objects.get_template("Template 2")
+        self.assertTrue(template._addresses('cc')[1] is
+                        template._addresses('cc')[1])
+        template.cc.append('ignored@example.com')
+        self.assertEqual(len(template.cc), 2)
+        template.cc = ['e@example.com']
+        self.assertEqual(len(template.cc), 3)
+        template.base_cc = ['f@example.com']
+        self.assertEqual(template.cc, ['f@example.com', 'e@example.com'])
+        template.base_cc.append('g@example.com')
+        self.assertEqual(template.cc, ['f@example.com', 'g@example.com',
+                                       'e@example.com'])
+        template.base_cc[0] = 'h@example.com'
+        self.assertEqual(template.cc, ['h@example.com', 'g@example.com',
+                                       'e@example.com'])
     # Ensure the subject renders correctly
 
     def test_render_subject_template(self):
@@ -364,6 +477,50 @@ class TemplateValidatorTest(TestCase):
             validate_template_syntax, 
             "hello {% if world %} world")
 
+    def test_not_rendered(self):
+        """Ensure templates are validated without being rendered"""
+        validate_template_syntax("{% url 'no-such-view' %}")
+
+    def test_compiled_template_reused(self):
+        """Ensure the template compiled for validation is used once saved"""
+        source = u"Validated {{ hello }}"
+        template = EmailMessageTemplate(name="Validated", subject_template=source,
+                                        description="Validated template")
+        template.full_clean()
+        template.save()
+        validated = validated_templates.get(source_key(source))
+        self.assertTrue(validated is not None)
+        self.assertTrue(
+            template.get_compiled_template('subject_template') is validated)
+
+    def test_context_names(self):
+        """Ensure names bound inside a template aren't context names"""
+        template = Template("{% for item in items %}{{ item.x }}"
+                            "{{ forloop.counter }}{% empty %}{{ item }}"
+                            "{% endfor %}{% with a=b %}{{ a }}{% endwith %}"
+                            "{% if c or not e %}{{ f|default:d }}{% endif %}")
+        self.assertEqual(context_names(template.nodelist),
+                         set(['items', 'item', 'b', 'c', 'd', 'e', 'f']))
+
+    def test_validate_context(self):
+        """Ensure templates using undeclared variables are rejected"""
+        validate_template_context("{{ a.b }} {{ c|upper }}", ['a', 'c'])
+        self.assertRaises(ValidationError, validate_template_context,
+                          "{{ a.b }} {{ c|upper }}", ['a'])
+
+    def test_context_schema(self):
+        """Ensure templates are checked against their declared schema"""
+        template = EmailMessageTemplate(name="Schema",
+                                        subject_template="{{ hello }}",
+                                        body_template="{{ world }}",
+                                        description="Schema template")
+        with self.settings(EMAILTEMPLATES_CONTEXT_SCHEMAS={
+                'Schema': ['hello', 'world']}):
+            template.full_clean()
+        with self.settings(EMAILTEMPLATES_CONTEXT_SCHEMAS={
+                'Schema': ['hello']}):
+            self.assertRaises(ValidationError, template.full_clean)
+
 
 class UtilityFunctionTest(TestCase):
     """
@@ -406,6 +563,83 @@ class UtilityFunctionTest(TestCase):
         self.assertEqual(mail.outbox[1].body, "Test 1 body -EARTH-")
         self.assertEqual(mail.outbox[1].to, ['to2@example.com'])
 
+    def test_send_mass_mail_chunked(self):
+        """Ensure send_mass_mail sends every chunk and counts the messages"""
+        datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                     for i in range(5)]
+        sent = send_mass_mail("Template 1", datatuple=datatuple, chunk_size=2)
+
+        self.assertEqual(sent, 5)
+        self.assertEqual([m.to for m in mail.outbox],
+                         [['to{0}@example.com'.format(i)] for i in range(5)])
+
+    def test_iter_send_mass_mail(self):
+        """
+        Ensure iter_send_mass_mail consumes a generator lazily and reports 
+        each chunk
+        """
+        consumed = []
+        def datatuple():
+            for i in range(5):
+                consumed.append(i)
+                yield (self.context, None, ['to{0}@example.com'.format(i)])
+
+        results = iter_send_mass_mail("Template 1", datatuple=datatuple(),
+                                      chunk_size=2)
+        self.assertEqual(next(results), 2)
+        self.assertEqual(consumed, [0, 1])
+        self.assertEqual(list(results), [2, 1])
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_send_mass_mail_process_pool(self):
+        """Ensure messages rendered in worker processes are sent in order"""
+        datatuple = [(self.context if i % 2 else self.context2, None,
+                      ['to{0}@example.com'.format(i)]) for i in range(7)]
+        sent = send_mass_mail("Template 1", datatuple=datatuple, chunk_size=3,
+                              workers=2, pool='process')
+
+        self.assertEqual(sent, 7)
+        self.assertEqual([m.to for m in mail.outbox],
+                         [['to{0}@example.com'.format(i)] for i in range(7)])
+        self.assertEqual(mail.outbox[0].subject, 'Test 1 Subject -GOODBYE-')
+        self.assertEqual(mail.outbox[1].subject, 'Test 1 Subject *HELLO*')
+
+    def test_send_mass_mail_thread_pool(self):
+        """Ensure messages rendered in worker threads are sent in order"""
+        datatuple = [(self.context if i % 2 else self.context2, None,
+                      ['to{0}@example.com'.format(i)]) for i in range(7)]
+        sent = send_mass_mail("Template 1", datatuple=datatuple, chunk_size=3,
+                              workers=2, pool='thread')
+
+        self.assertEqual(sent, 7)
+        self.assertEqual([m.to for m in mail.outbox],
+                         [['to{0}@example.com'.format(i)] for i in range(7)])
+        self.assertEqual(mail.outbox[5].body, "Test 1 body *WORLD*")
+        self.assertEqual(mail.outbox[6].body, "Test 1 body -EARTH-")
+
+    def test_send_mass_mail_attachments(self):
+        """Ensure attachments are encoded once and shared by all messages"""
+        encode_base64 = encoders.encode_base64
+        encoded = []
+        def counting_encode_base64(msg):
+            encoded.append(msg)
+            encode_base64(msg)
+        encoders.encode_base64 = counting_encode_base64
+        try:
+            datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                         for i in range(3)]
+            send_mass_mail("Template 1", datatuple=datatuple,
+                           attachments=[('report.pdf', '%PDF-1.4 data',
+                                         'application/pdf')])
+            parts = [m.message().get_payload(1) for m in mail.outbox]
+        finally:
+            encoders.encode_base64 = encode_base64
+
+        self.assertEqual(len(encoded), 1)
+        self.assertTrue(parts[0] is parts[1] is parts[2])
+        self.assertEqual(parts[0].get_filename(), 'report.pdf')
+        self.assertEqual(parts[0].get_payload(decode=True), '%PDF-1.4 data')
+
     def test_mail_admins(self):
         """Ensure the mail_admins function works"""
         with self.settings(ADMINS=(('a','admin1@example.com'),
@@ -435,3 +669,1229 @@ class UtilityFunctionTest(TestCase):
         self.assertEqual(mail.outbox[0].body, "Test 1 body *WORLD*")
         self.assertEqual(mail.outbox[0].to, ['admin1@example.com', 
                                              'admin2@example.com'])
+
+
+class CompiledTemplateCacheTest(TestCase):
+    """
+    Ensure that compiled templates are reused between renders and discarded 
+    when the underlying template changes
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def setUp(self):
+        compiled_templates.clear()
+
+    def test_compiled_template_reused(self):
+        """Ensure a template is only compiled once per version"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        compiled = template.get_compiled_template('subject_template')
+        other = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertTrue(other.get_compiled_template('subject_template') is compiled)
+
+    def test_save_invalidates(self):
+        """Ensure saving a template discards its compiled templates"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.get_compiled_template('subject_template')
+        template.subject_template = "Changed {{hello}}"
+        template.save()
+        self.assertFalse([k for k in compiled_templates._map if k[0] == 1])
+
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = self.context
+        self.assertEqual(template.subject, "Changed *HELLO*")
+
+    def test_unsaved_source_change(self):
+        """Ensure unsaved edits to a template's source are rendered"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = self.context
+        template.subject
+        template.subject_template = "Unsaved {{hello}}"
+        self.assertEqual(template.subject, "Unsaved *HELLO*")
+
+    def test_deferred_sources(self):
+        """Ensure body fields are only loaded when a template is compiled"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertTrue('body_template' in template.get_deferred_fields())
+        template.context = self.context
+        with self.assertNumQueries(1):
+            template.subject
+            template.body
+        self.assertFalse('body_template' in template.get_deferred_fields())
+
+        with self.settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=100):
+            EmailMessageTemplate.objects.get_template("Template 1")
+            with self.assertNumQueries(0):
+                other = EmailMessageTemplate.objects.get_template("Template 1")
+                other.context = self.context
+                self.assertEqual(other.body, template.body)
+        self.assertTrue('body_template' in other.get_deferred_fields())
+
+    def test_deferred_template_class(self):
+        """Ensure lookups return templates that send the usual signals"""
+        saved = []
+        def receiver(sender, instance, **kwargs):
+            saved.append(instance)
+        post_save.connect(receiver, sender=EmailMessageTemplate)
+        try:
+            template = EmailMessageTemplate.objects.get_template("Template 1")
+            self.assertTrue(type(template) is EmailMessageTemplate)
+            template.description = "Changed"
+            template.save()
+        finally:
+            post_save.disconnect(receiver, sender=EmailMessageTemplate)
+        self.assertEqual(saved, [template])
+        template = EmailMessageTemplate.objects.get(pk=1)
+        self.assertEqual(template.description, "Changed")
+        self.assertEqual(template.body_template, "Test 1 body {{world}}")
+
+    def test_lru_eviction(self):
+        """Ensure the least recently used entries are evicted first"""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class RenderedMessageTest(TestCase):
+    """
+    Ensure that a template is rendered once per context and that the rendered 
+    content is reused until the context or template changes
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+    context2 = {'hello': '-GOODBYE-', 'world': '-EARTH-'}
+
+    def test_prepare_reused(self):
+        """Ensure repeated reads use the same rendered content"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = self.context
+        rendered = template.prepare()
+        self.assertEqual(rendered.subject, "Test 1 Subject *HELLO*")
+        self.assertEqual(rendered.body, "Test 1 body *WORLD*")
+        self.assertEqual(rendered.html, None)
+        self.assertTrue(template.prepare() is rendered)
+
+    def test_prepare_invalidated(self):
+        """Ensure changes to the context or template produce a new render"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = self.context
+        template.prepare()
+        template.context = self.context2
+        self.assertEqual(template.subject, "Test 1 Subject -GOODBYE-")
+        template.subject_prefix = "[PREFIX] "
+        self.assertEqual(template.subject, "[PREFIX] Test 1 Subject -GOODBYE-")
+        template.body_template = "Changed {{world}}"
+        self.assertEqual(template.body, "Changed -EARTH-")
+
+    def test_context_changed_in_place(self):
+        """Ensure values set on the context after rendering are used"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = dict(self.context)
+        self.assertEqual(template.subject, "Test 1 Subject *HELLO*")
+        template.context['hello'] = '-GOODBYE-'
+        self.assertEqual(template.subject, "Test 1 Subject -GOODBYE-")
+        template.context.update({'hello': '*AGAIN*'})
+        self.assertEqual(template.subject, "Test 1 Subject *AGAIN*")
+        template.context.pop()
+        self.assertEqual(template.subject, "Test 1 Subject -GOODBYE-")
+
+    def test_html_rendered_once(self):
+        """Ensure sending an HTML message renders the HTML template once"""
+        with self.settings(EMAILTEMPLATES_ALLOW_HTML_MESSAGES=True):
+            template = EmailMessageTemplate.objects.get_template("Template 5")
+            compiled = template.get_compiled_template('body_template_html')
+            renders = []
+            def render(context):
+                renders.append(context)
+                return type(compiled).render(compiled, context)
+            compiled.render = render
+            try:
+                template.context = self.context
+                template.to = ['to@example.com']
+                template.send()
+            finally:
+                del compiled.render
+            self.assertEqual(len(renders), 1)
+            self.assertEqual(len(mail.outbox), 1)
+
+
+class TemplatedMessageTest(TestCase):
+    """
+    Ensure that messages built for bulk sending match the template they were 
+    produced from and are cheaper to build than copies of the template
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def test_templated_message(self):
+        """Ensure a templated message carries the rendered content"""
+        template = EmailMessageTemplate.objects.get_template("Template 2")
+        message = TemplatedMessage(template, self.context, None,
+                                   ['to@example.com'])
+        self.assertEqual(message.subject, "Test 2 Subject *HELLO*")
+        self.assertEqual(message.body, "Test 2 body *WORLD*")
+        self.assertEqual(message.from_email, 'example@example.com')
+        self.assertEqual(message.to, ['to@example.com'])
+        self.assertEqual(sorted(message.cc), ['a@example.com', 'b@example.com'])
+        self.assertEqual(sorted(message.bcc), ['c@example.com', 'd@example.com'])
+
+    def test_templated_message_html(self):
+        """Ensure a templated message includes the HTML alternative"""
+        with self.settings(EMAILTEMPLATES_ALLOW_HTML_MESSAGES=True):
+            template = EmailMessageTemplate.objects.get_template("Template 5")
+            message = TemplatedMessage(template, self.context, None,
+                                       ['to@example.com'])
+            self.assertEqual(len(message.alternatives), 1)
+            self.assertTrue("<h1>*HELLO* *WORLD* in HTML!</h1>" in
+                            message.alternatives[0][0])
+
+    def test_benchmark_against_deepcopy(self):
+        """
+        Compare building messages from a shared template with the previous 
+        approach of deep-copying the template for each recipient
+        """
+        template = EmailMessageTemplate.objects.get_template("Template 2")
+        datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                     for i in range(200)]
+
+        start = time.time()
+        for (context, from_email, recipient_list) in datatuple:
+            message = copy.deepcopy(template)
+            message.context = context
+            message.from_email = from_email
+            message.to = recipient_list
+            message.message()
+        deepcopy_time = time.time() - start
+
+        start = time.time()
+        for (context, from_email, recipient_list) in datatuple:
+            TemplatedMessage(template, context, from_email,
+                             recipient_list).message()
+        shared_time = time.time() - start
+
+        self.assertTrue(shared_time < deepcopy_time,
+                        "Shared: {0:.4f}s, deepcopy: {1:.4f}s".format(
+                            shared_time, deepcopy_time))
+
+
+class TemplateRegistryTest(TestCase):
+    """
+    Ensure that the per-process template registry answers repeated lookups 
+    without querying the database and forgets them when templates change
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        template_registry.clear()
+
+    def test_registry_hit(self):
+        """Ensure a repeated lookup is answered from the registry"""
+        with self.settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=100):
+            first = EmailMessageTemplate.objects.get_template("Template 1")
+            with self.assertNumQueries(0):
+                second = EmailMessageTemplate.objects.get_template("Template 1")
+            self.assertEqual(second.pk, 1)
+            self.assertEqual(second.subject_template, first.subject_template)
+            self.assertFalse(second is first)
+
+    def test_registry_fallback_miss(self):
+        """Ensure misses on the object-specific template are remembered"""
+        site = Site.objects.get(pk=2)
+        with self.settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=100):
+            EmailMessageTemplate.objects.get_template("Template 1", site)
+            self.assertRaises(EmailMessageTemplate.DoesNotExist,
+                lambda: EmailMessageTemplate.objects.get_template(
+                    "Nonexistent Template", site))
+            with self.assertNumQueries(0):
+                template = EmailMessageTemplate.objects.get_template(
+                    "Template 1", site)
+                self.assertEqual(template.pk, 1)
+                self.assertRaises(EmailMessageTemplate.DoesNotExist,
+                    lambda: EmailMessageTemplate.objects.get_template(
+                        "Nonexistent Template", site))
+
+    def test_registry_invalidated_on_save(self):
+        """Ensure saving a template makes new templates visible"""
+        site = Site.objects.get(pk=2)
+        with self.settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=100):
+            EmailMessageTemplate.objects.get_template("Template 1", site)
+            EmailMessageTemplate.objects.create(name="Template 1",
+                related_object=site, subject_template="Site 2 {{hello}}")
+            template = EmailMessageTemplate.objects.get_template("Template 1",
+                                                                 site)
+            self.assertEqual(template.subject_template, "Site 2 {{hello}}")
+
+    def test_registry_expiry(self):
+        """Ensure expired registry entries are looked up again"""
+        with self.settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=100,
+                           EMAILTEMPLATES_TEMPLATE_REGISTRY_TTL=-1):
+            EmailMessageTemplate.objects.get_template("Template 1")
+            with self.assertNumQueries(1):
+                EmailMessageTemplate.objects.get_template("Template 1")
+
+
+class SharedTemplateCacheTest(TestCase):
+    """
+    Ensure that template lookups are shared between processes through the 
+    configured cache and retired when templates change
+    """
+    fixtures = ['test_templates',]
+    caches = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'emailtemplates': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'emailtemplates-tests',
+        },
+    }
+
+    def setUp(self):
+        template_registry.clear()
+
+    def tearDown(self):
+        with self.settings(CACHES=self.caches,
+                           EMAILTEMPLATES_TEMPLATE_CACHE='emailtemplates'):
+            get_shared_cache().clear()
+
+    def test_shared_cache_hit(self):
+        """Ensure a lookup made elsewhere is answered from the cache"""
+        site = Site.objects.get(pk=2)
+        ContentType.objects.get_for_model(site)
+        with self.settings(CACHES=self.caches,
+                           EMAILTEMPLATES_TEMPLATE_CACHE='emailtemplates'):
+            EmailMessageTemplate.objects.get_template("Template 1", site)
+            with self.assertNumQueries(0):
+                template = EmailMessageTemplate.objects.get_template(
+                    "Template 1", site)
+            self.assertEqual(template.pk, 1)
+            self.assertEqual(template.subject_template,
+                             "Test 1 Subject {{hello}}")
+
+    def test_shared_cache_invalidated(self):
+        """Ensure saving a template retires the cached lookups"""
+        with self.settings(CACHES=self.caches,
+                           EMAILTEMPLATES_TEMPLATE_CACHE='emailtemplates'):
+            template = EmailMessageTemplate.objects.get_template("Template 1")
+            template.subject_template = "Changed {{hello}}"
+            template.save()
+            with self.assertNumQueries(1):
+                template = EmailMessageTemplate.objects.get_template(
+                    "Template 1")
+            self.assertEqual(template.subject_template, "Changed {{hello}}")
+
+    def test_stale_rows_not_stored(self):
+        """Ensure rows fetched before a version change aren't stored"""
+        key = ("Template 1", None, None)
+        with self.settings(CACHES=self.caches,
+                           EMAILTEMPLATES_TEMPLATE_CACHE='emailtemplates'):
+            version = get_shared_version()
+            bump_shared_version()
+            set_shared_rows({key: ('stale',)}, version)
+            self.assertEqual(get_shared_rows([key], version), {})
+            self.assertEqual(get_shared_rows([key], get_shared_version()), {})
+
+    def test_version_evicted(self):
+        """Ensure a version evicted after a burst of saves isn't reused"""
+        class Clock(object):
+            now = 1000.0
+            def time(self):
+                return self.now
+        clock = Clock()
+        self.addCleanup(setattr, cache, 'time', cache.time)
+        cache.time = clock
+        with self.settings(CACHES=self.caches,
+                           EMAILTEMPLATES_TEMPLATE_CACHE='emailtemplates'):
+            version = get_shared_version()
+            for i in range(5):
+                bump_shared_version()
+            clock.now += 0.001
+            get_shared_cache().delete(cache.SHARED_VERSION_KEY)
+            self.assertTrue(get_shared_version() > version + 5)
+
+    def test_bumped_after_transaction(self):
+        """Ensure the version is bumped again once a transaction ends"""
+        with self.settings(CACHES=self.caches,
+                           EMAILTEMPLATES_TEMPLATE_CACHE='emailtemplates'):
+            version = get_shared_version()
+            #Tests run in a transaction
+            bump_shared_version('default')
+            self.assertEqual(get_shared_version(), version + 1)
+            in_transaction = cache._in_transaction
+            cache._in_transaction = lambda using: False
+            try:
+                self.assertEqual(get_shared_version(), version + 2)
+                self.assertEqual(get_shared_version(), version + 2)
+            finally:
+                cache._in_transaction = in_transaction
+
+
+class TemplateWarmingTest(TestCase):
+    """
+    Ensure that templates can be preloaded into the template caches
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        compiled_templates.clear()
+        template_registry.clear()
+
+    def test_warm(self):
+        """Ensure warming compiles and registers enabled templates"""
+        with self.settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=100):
+            timings = EmailMessageTemplate.objects.warm()
+            self.assertEqual(sorted(t.pk for t, seconds in timings),
+                             [1, 2, 4, 6, 7, 8])
+            template = [t for t, seconds in timings if t.pk == 1][0]
+            self.assertTrue((1, 'subject_template', template.edited_date)
+                            in compiled_templates)
+            with self.assertNumQueries(0):
+                EmailMessageTemplate.objects.get_template("Template 2")
+
+    def test_warm_names(self):
+        """Ensure warming can be limited to named templates"""
+        timings = EmailMessageTemplate.objects.warm(names=["Template 1"])
+        self.assertEqual(sorted(t.pk for t, seconds in timings), [1, 4])
+
+    def test_preload_command(self):
+        """Ensure the preload command reports each template it loads"""
+        out = StringIO()
+        call_command('preload_emailtemplates', 'Template 5', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("Template 5: "))
+        self.assertTrue(lines[1].startswith("Preloaded 1 templates in "))
+
+
+class TextConversionTest(TestCase):
+    """
+    Ensure that autogenerated plain text is converted once per distinct HTML 
+    content
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+    context2 = {'hello': '-GOODBYE-', 'world': '-EARTH-'}
+
+    def setUp(self):
+        text_conversions.clear()
+        self.html2text = converters.html2text
+        self.conversions = []
+        test = self
+        class CountingConverter(object):
+            def html2text(self, html):
+                test.conversions.append(html)
+                return test.html2text.html2text(html)
+        converters.html2text = CountingConverter()
+
+    def tearDown(self):
+        converters.html2text = self.html2text
+
+    def test_conversion_reused(self):
+        """Ensure identical HTML content is only converted once"""
+        with self.settings(EMAILTEMPLATES_ALLOW_HTML_MESSAGES=True):
+            template = EmailMessageTemplate.objects.get_template("Template 5")
+            first = template.render(Context(self.context))
+            second = template.render(Context(self.context))
+            third = template.render(Context(self.context2))
+        self.assertEqual(first.body, second.body)
+        self.assertTrue("# *HELLO* *WORLD* in HTML!" in first.body)
+        self.assertTrue("# -GOODBYE- -EARTH- in HTML!" in third.body)
+        self.assertEqual(len(self.conversions), 2)
+
+    def test_html2text_unavailable(self):
+        """Ensure the text template is used when html2text is missing"""
+        converters.html2text = None
+        with self.settings(EMAILTEMPLATES_ALLOW_HTML_MESSAGES=True):
+            template = EmailMessageTemplate.objects.get_template("Template 5")
+            template.body_template = "{{hello}} in text"
+            template.context = self.context
+            self.assertEqual(template.body, "*HELLO* in text")
+
+
+class SimpleTextConverterTest(TestCase):
+    """
+    Ensure that the built-in text converter handles common email markup, and 
+    compare its speed with html2text
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+    newsletter_section = """
+        <table width="100%" cellpadding="0" cellspacing="0">
+          <tr><td class="header"><img src="logo.png" alt="Example News">
+          </td></tr>
+          <tr><td>
+            <h2>Story {0}: Something happened</h2>
+            <p>Lorem ipsum dolor sit amet, <b>consectetur</b> adipiscing elit,
+            sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.
+            <a href="http://example.com/story/{0}">Read more</a></p>
+            <ul><li>First point</li><li>Second point</li></ul>
+            <table><tr><th>Item</th><th>Price</th></tr>
+            <tr><td>Widget</td><td>&pound;{0}.99</td></tr></table>
+          </td></tr>
+        </table>"""
+
+    def test_convert_markup(self):
+        """Ensure headings, links, lists and tables are converted"""
+        html = ("<html><head><style>p {color: red}</style></head><body>"
+                "<h1>Hello  <i>World</i></h1><p>Visit <a href='http://a.com/'>"
+                "our site</a> &amp; <a href='http://b.com/'>http://b.com/</a>"
+                "<br>today</p><ol><li>One</li><li>Two<ul><li>Nested</li></ul>"
+                "</li></ol><table><tr><td>A</td><td>B</td></tr></table>"
+                "</body></html>")
+        self.assertEqual(SimpleTextConverter().convert(html),
+                         u"# Hello World\n\n"
+                         u"Visit our site (http://a.com/) & http://b.com/\n"
+                         u"today\n\n"
+                         u"1. One\n2. Two\n  * Nested\n\n"
+                         u"A\tB")
+
+    def test_simple_converter_setting(self):
+        """Ensure the configured converter is used for autogenerated text"""
+        with self.settings(EMAILTEMPLATES_ALLOW_HTML_MESSAGES=True,
+                           EMAILTEMPLATES_TEXT_CONVERTER=
+                           'emailtemplates.converters.SimpleTextConverter'):
+            template = EmailMessageTemplate.objects.get_template("Template 5")
+            template.context = self.context
+            self.assertEqual(template.body, u"# *HELLO* *WORLD* in HTML!\n\n"
+                                            u"This is an HTML message!")
+
+    def test_benchmark_converters(self):
+        """
+        Compare the time taken to convert a realistic newsletter with each 
+        converter
+        """
+        html = "<html><body>{0}</body></html>".format("".join(
+            self.newsletter_section.format(i) for i in range(50)))
+        timings = {}
+        for converter in (Html2TextConverter(), SimpleTextConverter()):
+            if not converter.available:
+                continue
+            start = time.time()
+            text = converter.convert(html)
+            timings[type(converter).__name__] = time.time() - start
+            self.assertTrue("Story 49: Something happened" in text)
+
+        if 'Html2TextConverter' in timings:
+            self.assertTrue(timings['SimpleTextConverter'] <
+                            timings['Html2TextConverter'], timings)
+
+
+class SegmentedTemplateTest(TestCase):
+    """
+    Ensure that the parts of a template that don't depend on per-recipient 
+    context are rendered once per campaign
+    """
+    fixtures = ['test_templates',]
+
+    def test_static_segments_rendered_once(self):
+        """Ensure static segments are reused and dynamic ones re-rendered"""
+        calls = []
+        def title():
+            calls.append(1)
+            return "News"
+        template = SegmentedTemplate(Template(
+            "<h1>{{ title }}</h1>{% if name %}Hi {{ name|upper }}{% endif %}"
+            "{% for item in items %}{{ item }}{% endfor %}"), ['name'])
+        self.assertEqual([dynamic for dynamic, nodes in template.segments],
+                         [False, True, False])
+
+        first = template.render(Context({'title': title, 'name': 'ann',
+                                         'items': [1, 2]}))
+        second = template.render(Context({'title': title, 'name': 'bob',
+                                          'items': [1, 2]}))
+        self.assertEqual(first, "<h1>News</h1>Hi ANN12")
+        self.assertEqual(second, "<h1>News</h1>Hi BOB12")
+        self.assertEqual(len(calls), 1)
+
+    def test_unknown_tags_dynamic(self):
+        """Ensure tags that may depend on more than variables are dynamic"""
+        template = SegmentedTemplate(Template(
+            "{% cycle 'a' 'b' %}{% now 'Y' %}{{ title }}"), ['name'])
+        self.assertEqual([dynamic for dynamic, nodes in template.segments],
+                         [True, False])
+
+    def test_send_mass_mail_recipient_keys(self):
+        """Ensure segmented bulk sends produce the same messages"""
+        datatuple = [({'hello': 'Hi', 'world': 'World {0}'.format(i)}, None,
+                      ['to{0}@example.com'.format(i)]) for i in range(3)]
+        send_mass_mail("Template 1", datatuple=datatuple,
+                       recipient_keys=['world'])
+        self.assertEqual([m.subject for m in mail.outbox],
+                         ['Test 1 Subject Hi'] * 3)
+        self.assertEqual([m.body for m in mail.outbox],
+                         ['Test 1 body World {0}'.format(i) for i in range(3)])
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+    """
+    A local SMTP server that records the messages it receives, run in a 
+    background thread
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.peers = set()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.peers.add(peer)
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+        asyncore.close_all()
+
+
+class BackgroundSendingTest(TestCase):
+    """
+    Ensure that messages can be sent without blocking the caller, and 
+    delivered over several SMTP connections at once
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def test_send_async(self):
+        """Ensure a template can be sent in the background"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = self.context
+        template.to = ['to@example.com']
+        self.assertEqual(template.send_async().get(5), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Test 1 Subject *HELLO*')
+
+    def test_send_mail_async(self):
+        """Ensure send_mail_async sends the message in the background"""
+        result = send_mail_async("Template 1", context=self.context,
+                                 recipient_list=['to@example.com'])
+        self.assertEqual(result.get(5), 1)
+        self.assertEqual(mail.outbox[0].body, "Test 1 body *WORLD*")
+
+    def test_send_mass_mail_async(self):
+        """Ensure send_mass_mail_async sends every message"""
+        datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                     for i in range(3)]
+        result = send_mass_mail_async("Template 1", datatuple=datatuple)
+        self.assertEqual(result.get(5), 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_concurrent_smtp_backend(self):
+        """Ensure the concurrent backend delivers over several connections"""
+        server = RecordingSMTPServer()
+        server.start()
+        try:
+            connection = ConcurrentSMTPBackend(host='127.0.0.1',
+                                               port=server.port,
+                                               username='', password='',
+                                               use_tls=False, concurrency=3)
+            datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                         for i in range(7)]
+            sent = send_mass_mail("Template 1", datatuple=datatuple,
+                                  connection=connection)
+        finally:
+            server.stop()
+
+        self.assertEqual(sent, 7)
+        self.assertEqual(sorted(m[1][0] for m in server.messages),
+                         sorted('to{0}@example.com'.format(i)
+                                for i in range(7)))
+        self.assertEqual(len(server.peers), 3)
+
+
+class ConnectionPoolTest(TestCase):
+    """
+    Ensure that the convenience functions reuse open connections, and replace
+    ones that have gone stale
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def setUp(self):
+        connection_pool.close_all()
+        self.server = RecordingSMTPServer()
+        self.server.start()
+        self.smtp_settings = self.settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.port,
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False)
+        self.smtp_settings.enable()
+
+    def tearDown(self):
+        connection_pool.close_all()
+        self.smtp_settings.disable()
+        self.server.stop()
+
+    def send(self, recipient):
+        return send_mail("Template 1", context=self.context,
+                         recipient_list=[recipient])
+
+    def test_connection_reused(self):
+        """Ensure consecutive send_mail calls share one SMTP connection"""
+        for i in range(3):
+            self.assertEqual(self.send('to{0}@example.com'.format(i)), 1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(len(self.server.peers), 1)
+
+    def test_pool_size_zero(self):
+        """Ensure pooling can be disabled"""
+        with self.settings(EMAILTEMPLATES_CONNECTION_POOL_SIZE=0):
+            for i in range(2):
+                self.send('to{0}@example.com'.format(i))
+        self.assertEqual(len(self.server.peers), 2)
+
+    def test_idle_timeout(self):
+        """Ensure connections idle for too long are replaced"""
+        with self.settings(EMAILTEMPLATES_CONNECTION_POOL_IDLE_TIMEOUT=-1):
+            for i in range(2):
+                self.send('to{0}@example.com'.format(i))
+        self.assertEqual(len(self.server.peers), 2)
+
+    def test_dropped_connection_replaced(self):
+        """Ensure a connection that fails its health check is replaced"""
+        self.send('to0@example.com')
+        connection = connection_pool.acquire()
+        connection.connection.sock.close()
+        connection_pool.release(connection)
+
+        self.assertEqual(self.send('to1@example.com'), 1)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(len(self.server.peers), 2)
+
+    def test_dropped_sub_connection_closed(self):
+        """Ensure dropped extra connections of a concurrent backend are closed"""
+        with self.settings(
+                EMAIL_BACKEND='emailtemplates.backends.ConcurrentSMTPBackend'):
+            datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                         for i in range(4)]
+            send_mass_mail("Template 1", datatuple=datatuple)
+            connection = connection_pool.acquire()
+            backend = connection._backends[0]
+            backend.connection.sock.close()
+            connection_pool.release(connection)
+
+            self.assertTrue(connection_pool.acquire() is connection)
+            self.assertEqual(backend.connection, None)
+            connection_pool.release(connection)
+            self.assertEqual(send_mass_mail("Template 1", datatuple=datatuple),
+                             4)
+        self.assertEqual(len(self.server.messages), 8)
+
+    def test_error_keeps_connection(self):
+        """Ensure errors unrelated to the connection don't discard it"""
+        def fail():
+            with pooled_connection():
+                raise ValueError("Rendering failed")
+        self.send('to0@example.com')
+        self.assertRaises(ValueError, fail)
+        self.send('to1@example.com')
+        self.assertEqual(len(self.server.peers), 1)
+
+    def test_mass_mail_uses_pool(self):
+        """Ensure send_mass_mail returns its connection to the pool"""
+        datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                     for i in range(3)]
+        self.assertEqual(send_mass_mail("Template 1", datatuple=datatuple), 3)
+        self.send('to3@example.com')
+        self.assertEqual(len(self.server.messages), 4)
+        self.assertEqual(len(self.server.peers), 1)
+
+
+class FailingBackend(BaseEmailBackend):
+    """
+    An email backend that can't deliver anything
+    """
+
+    def send_messages(self, email_messages):
+        raise IOError("Connection refused")
+
+
+class DroppingBackend(LocmemBackend):
+    """
+    A locmem email backend whose connection drops, like an SMTP backend's, 
+    on the sends listed in drops, and stays dropped until it is reopened 
+    (which fails if refuse is set).  Sends listed in interrupts are 
+    interrupted instead.
+    """
+    drops = ()
+    interrupts = ()
+    refuse = False
+    sends = 0
+    opened = 0
+
+    def __init__(self, *args, **kwargs):
+        super(DroppingBackend, self).__init__(*args, **kwargs)
+        self.connection = None
+
+    def open(self):
+        if self.connection is not None:
+            return False
+        if self.refuse and DroppingBackend.opened:
+            raise socket.error("Connection refused")
+        DroppingBackend.opened += 1
+        self.connection = 'open'
+        return True
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, messages):
+        DroppingBackend.sends += 1
+        if DroppingBackend.sends in self.interrupts:
+            raise KeyboardInterrupt
+        if DroppingBackend.sends in self.drops:
+            self.connection = 'dropped'
+        if self.connection == 'dropped':
+            raise smtplib.SMTPServerDisconnected("Connection closed")
+        return super(DroppingBackend, self).send_messages(messages)
+
+
+class QueuedSendingTest(TestCase):
+    """
+    Ensure that queued messages are stored, claimed by one worker at a time, 
+    sent in batches and retried with backoff
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def queue(self, count=1):
+        return [send_mail("Template 1", context=self.context,
+                          recipient_list=['to{0}@example.com'.format(i)],
+                          queue=True)
+                for i in range(count)]
+
+    def test_queue(self):
+        """Ensure queueing stores the message without sending it"""
+        job = self.queue()[0]
+        self.assertEqual(len(mail.outbox), 0)
+        job = QueuedMessage.objects.get(pk=job.pk)
+        self.assertEqual(job.template.name, "Template 1")
+        self.assertEqual(job.recipients, ['to0@example.com'])
+        self.assertEqual(job.status, QueuedMessage.QUEUED)
+
+    def test_queue_with_connection(self):
+        """Ensure custom connections can't be used for queued messages"""
+        self.assertRaises(ValueError, send_mail, "Template 1", queue=True,
+                          recipient_list=['to@example.com'], auth_user='me')
+
+    def test_process_queue(self):
+        """Ensure the worker sends and removes due messages"""
+        self.queue(3)
+        self.assertEqual(process_queue(batch_size=2), (2, 0))
+        self.assertEqual(process_queue(batch_size=2), (1, 0))
+        self.assertEqual(process_queue(batch_size=2), (0, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].subject, 'Test 1 Subject *HELLO*')
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+
+    def test_claim(self):
+        """Ensure claimed messages aren't claimed again until the lease ends"""
+        self.queue(3)
+        first = QueuedMessage.objects.claim(2, 'a', 300)
+        second = QueuedMessage.objects.claim(2, 'b', 300)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(j.pk for j in first) & set(j.pk for j in second))
+        self.assertEqual(QueuedMessage.objects.claim(2, 'c', 300), [])
+        self.assertEqual(len(QueuedMessage.objects.claim(5, 'd', -1)), 3)
+
+    def test_retry(self):
+        """Ensure failed messages are retried later and eventually abandoned"""
+        job = self.queue()[0]
+        backend = 'emailtemplates.tests.FailingBackend'
+        with self.settings(EMAIL_BACKEND=backend,
+                           EMAILTEMPLATES_QUEUE_MAX_ATTEMPTS=2):
+            self.assertEqual(process_queue(), (0, 1))
+            job = QueuedMessage.objects.get(pk=job.pk)
+            self.assertEqual(job.attempts, 1)
+            self.assertEqual(job.status, QueuedMessage.QUEUED)
+            self.assertTrue(job.next_attempt > timezone.now())
+            self.assertTrue("Connection refused" in job.last_error)
+            self.assertEqual(process_queue(), (0, 0))
+
+            QueuedMessage.objects.update(next_attempt=timezone.now())
+            self.assertEqual(process_queue(), (0, 1))
+            self.assertEqual(QueuedMessage.objects.get(pk=job.pk).status,
+                             QueuedMessage.FAILED)
+            QueuedMessage.objects.update(next_attempt=timezone.now())
+            self.assertEqual(process_queue(), (0, 0))
+
+    def dropping_backend(self, **attrs):
+        attrs.update(sends=0, opened=0)
+        for name, value in attrs.items():
+            self.addCleanup(setattr, DroppingBackend, name,
+                            getattr(DroppingBackend, name))
+            setattr(DroppingBackend, name, value)
+        return self.settings(
+            EMAIL_BACKEND='emailtemplates.tests.DroppingBackend',
+            EMAILTEMPLATES_CONNECTION_POOL_SIZE=0)
+
+    def test_dropped_connection(self):
+        """Ensure a dropped connection is reopened for the rest of the batch"""
+        jobs = self.queue(3)
+        with self.dropping_backend(drops=(1,)):
+            self.assertEqual(process_queue(), (2, 1))
+        self.assertEqual(DroppingBackend.opened, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        job = QueuedMessage.objects.get()
+        self.assertEqual(job.pk, jobs[0].pk)
+        self.assertEqual(job.attempts, 1)
+
+    def test_connection_refused(self):
+        """Ensure the rest of the batch is released if it can't reconnect"""
+        self.queue(3)
+        with self.dropping_backend(drops=(1,), refuse=True):
+            self.assertEqual(process_queue(), (0, 1))
+        jobs = QueuedMessage.objects.order_by('pk')
+        self.assertEqual([job.attempts for job in jobs], [1, 0, 0])
+        self.assertEqual([job.claimed_by for job in jobs], [None] * 3)
+        self.assertEqual(DroppingBackend.sends, 1)
+
+    def test_interrupted_batch(self):
+        """Ensure sent messages are removed even if the batch is interrupted"""
+        self.queue(3)
+        with self.dropping_backend(interrupts=(2,)):
+            self.assertRaises(KeyboardInterrupt, process_queue)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(QueuedMessage.objects.count(), 2)
+
+    def test_worker_command(self):
+        """Ensure the worker command drains the queue"""
+        self.queue(3)
+        out = StringIO()
+        call_command('run_emailtemplates_worker', once=True, stdout=out)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertTrue("Sent 3 messages" in out.getvalue())
+
+
+class InstrumentationTest(TestCase):
+    """
+    Ensure that sending reports phase timings, cache use and message sizes 
+    through the instrumentation signals
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def setUp(self):
+        compiled_templates.clear()
+        validated_templates.clear()
+        self.events = []
+        phase_timed.connect(self.record)
+        cache_accessed.connect(self.record)
+        message_built.connect(self.record)
+
+    def tearDown(self):
+        phase_timed.disconnect(self.record)
+        cache_accessed.disconnect(self.record)
+        message_built.disconnect(self.record)
+
+    def record(self, signal, **kwargs):
+        kwargs.pop('sender')
+        self.events.append((signal, kwargs))
+
+    def find(self, signal, **kwargs):
+        return [e for s, e in self.events if s is signal and
+                all(e[k] == v for k, v in kwargs.items())]
+
+    def test_send_mail(self):
+        """Ensure each phase of send_mail is timed and labelled"""
+        #Fix the Date and Message-ID headers, so that rebuilding the message 
+        #gives the same size
+        formatdate, make_msgid = message_module.formatdate, \
+            message_module.make_msgid
+        message_module.formatdate = lambda: "Sat, 19 May 2012 11:05:46 -0000"
+        message_module.make_msgid = lambda: "<1@example.com>"
+        self.addCleanup(setattr, message_module, 'formatdate', formatdate)
+        self.addCleanup(setattr, message_module, 'make_msgid', make_msgid)
+        send_mail("Template 1", context=self.context,
+                  recipient_list=['to@example.com'])
+        phases = set(e['phase'] for e in self.find(phase_timed,
+                                                    template_name="Template 1"))
+        self.assertEqual(phases, set(['lookup', 'compile', 'render', 'mime',
+                                      'send']))
+        for event in self.find(phase_timed):
+            self.assertTrue(event['duration'] >= 0)
+
+        size = self.find(message_built, template_name="Template 1")[0]['size']
+        self.assertEqual(size, len(mail.outbox[0].message().as_string()))
+
+    def test_compiled_cache(self):
+        """Ensure compiled template cache hits and misses are counted"""
+        for i in range(2):
+            send_mail("Template 1", context=self.context,
+                      recipient_list=['to@example.com'])
+        events = self.find(cache_accessed, cache='compiled')
+        self.assertEqual(sum(e['misses'] for e in events), 2)
+        self.assertEqual(sum(e['hits'] for e in events), 2)
+
+    def test_registry_cache(self):
+        """Ensure template registry lookups are counted"""
+        template_registry.clear()
+        with self.settings(EMAILTEMPLATES_TEMPLATE_REGISTRY_SIZE=10):
+            for i in range(2):
+                EmailMessageTemplate.objects.get_template("Template 1")
+        events = self.find(cache_accessed, cache='registry',
+                           template_name="Template 1")
+        self.assertEqual([(e['hits'], e['misses']) for e in events],
+                         [(0, 1), (1, 0)])
+
+    def test_mass_mail(self):
+        """Ensure bulk sends time each chunk"""
+        datatuple = [(self.context, None, ['to{0}@example.com'.format(i)])
+                     for i in range(3)]
+        send_mass_mail("Template 1", datatuple=datatuple, chunk_size=2)
+        self.assertEqual(len(self.find(phase_timed, phase='send')), 2)
+        self.assertEqual(len(self.find(message_built)), 3)
+
+
+class VariableIndexTest(TestCase):
+    """
+    Ensure that the context variables used by each template field are indexed 
+    when a template is saved, and that the index stays accurate
+    """
+    fixtures = ['test_templates',]
+
+    def create(self):
+        return EmailMessageTemplate.objects.create(
+            name="Indexed", description="Indexed template",
+            subject_template="Hi {{ user.first_name|title }}",
+            body_template="{% for item in items %}{{ item.name }}{% endfor %}"
+                          "{{ site }} {{ user.email }}")
+
+    def test_index_saved(self):
+        """Ensure the index is stored with the template"""
+        template = EmailMessageTemplate.objects.get(pk=self.create().pk)
+        validated_templates.clear()
+        self.assertEqual(template.variable_paths(),
+                         set(['user.first_name', 'items', 'site',
+                              'user.email']))
+        self.assertEqual(template.variable_paths(['subject_template']),
+                         set(['user.first_name']))
+        self.assertEqual(template.context_names(),
+                         set(['user', 'items', 'site']))
+        #The stored index was used without compiling anything
+        self.assertEqual(len(validated_templates), 0)
+
+    def test_stale_index(self):
+        """Ensure unsaved changes to template fields are reflected"""
+        template = self.create()
+        template.subject_template = "Hello {{ name }}"
+        self.assertEqual(template.context_names(['subject_template']),
+                         set(['name']))
+
+    def test_unindexed_template(self):
+        """Ensure templates saved without an index are indexed on demand"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertEqual(template.variable_index, '')
+        self.assertEqual(template.context_names(), set(['hello', 'world']))
+
+    def test_validate_context(self):
+        """Ensure contexts missing variables the template uses are rejected"""
+        template = self.create()
+        template.validate_context({'user': None, 'items': [], 'site': 'x',
+                                   'extra': 1})
+        self.assertRaises(ValidationError, template.validate_context,
+                          Context({'user': None, 'items': []}))
+
+
+class TemplateTransferTest(TestCase):
+    """
+    Ensure that templates can be exported and imported as JSON Lines
+    """
+    fixtures = ['test_templates',]
+
+    def export(self):
+        out = StringIO()
+        count = export_templates(out)
+        return count, out.getvalue().splitlines(True)
+
+    def test_round_trip(self):
+        """Ensure exported templates are recreated by importing them"""
+        count, lines = self.export()
+        self.assertEqual(count, EmailMessageTemplate.objects.count())
+        before = sorted(EmailMessageTemplate.objects.values_list(
+                'name', 'content_type', 'object_id', 'subject_template',
+                'base_cc', 'enabled'))
+        EmailMessageTemplate.objects.all().delete()
+
+        self.assertEqual(import_templates(lines, batch_size=2),
+                         (count, 0, 0))
+        after = sorted(EmailMessageTemplate.objects.values_list(
+                'name', 'content_type', 'object_id', 'subject_template',
+                'base_cc', 'enabled'))
+        self.assertEqual(before, after)
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertTrue(template.variable_index)
+
+    def test_unchanged(self):
+        """Ensure importing existing templates doesn't update them"""
+        count, lines = self.export()
+        self.assertEqual(import_templates(lines), (0, 0, count))
+
+    def test_update(self):
+        """Ensure changed templates are updated and caches refreshed"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = {'hello': 'H'}
+        self.assertEqual(template.subject, "Test 1 Subject H")
+        count, lines = self.export()
+        lines = [line.replace("Test 1 Subject", "New Subject")
+                 for line in lines]
+        self.assertEqual(import_templates(lines, workers=2),
+                         (0, 1, count - 1))
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.context = {'hello': 'H'}
+        self.assertEqual(template.subject, "New Subject H")
+
+    def test_invalid_lines(self):
+        """Ensure nothing is imported if any line is invalid"""
+        count, lines = self.export()
+        EmailMessageTemplate.objects.all().delete()
+        lines[1] = lines[1].replace('"subject_template": "',
+                                    '"subject_template": "{% if %}')
+        lines.append('{"name": "X", "content_type": ["no", "such"]}\n')
+        lines.append('"X"\n')
+        lines.append('[1, 2]\n')
+        lines.append('{"name": "X", "content_type": "sites"}\n')
+        try:
+            import_templates(lines, batch_size=1000)
+        except TemplateImportError as e:
+            self.assertEqual(len(e.errors), 5)
+            self.assertTrue(e.errors[0].startswith("Line 2: subject_template"))
+            self.assertTrue("unknown content type no.such" in e.errors[1])
+            self.assertTrue("not a JSON object" in e.errors[2])
+            self.assertTrue("not a JSON object" in e.errors[3])
+            self.assertTrue("content_type must be a list" in e.errors[4])
+        else:
+            self.fail("TemplateImportError not raised")
+        self.assertEqual(EmailMessageTemplate.objects.count(), 0)
+
+    def test_commands(self):
+        """Ensure the management commands export and import templates"""
+        out = StringIO()
+        call_command('export_emailtemplates', "Template 1", stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()),
+                         EmailMessageTemplate.objects.filter(
+                             name="Template 1").count())
+        self.assertRaises(CommandError, call_command, 'import_emailtemplates')
+
+
+class ShoutNode(Node):
+    def render(self, context):
+        return "SHOUT"
+
+shout_library = Library()
+shout_library.tag('shout', lambda parser, token: ShoutNode())
+
+
+class PrecompiledTemplateTest(TestCase):
+    """
+    Ensure that compiled templates stored with a template are loaded instead 
+    of parsing the source, and ignored when they no longer apply
+    """
+    fixtures = ['test_templates',]
+    context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def setUp(self):
+        self.events = []
+        cache_accessed.connect(self.record)
+        with self.settings(EMAILTEMPLATES_PRECOMPILE_TEMPLATES=True):
+            EmailMessageTemplate.objects.get(pk=1).save()
+        compiled_templates.clear()
+        validated_templates.clear()
+
+    def tearDown(self):
+        cache_accessed.disconnect(self.record)
+
+    def record(self, signal, **kwargs):
+        if kwargs['cache'] == 'precompiled':
+            self.events.append((kwargs['hits'], kwargs['misses']))
+
+    def render(self, template):
+        template.context = self.context
+        return (template.subject, template.body)
+
+    def test_load_precompiled(self):
+        """Ensure stored compiled templates are used"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertEqual(self.render(template),
+                         ("Test 1 Subject *HELLO*", "Test 1 body *WORLD*"))
+        self.assertEqual(self.events, [(1, 0), (1, 0)])
+
+    def test_version_change(self):
+        """Ensure templates stored by another version are compiled again"""
+        template = EmailMessageTemplate.objects.get(pk=1)
+        EmailMessageTemplate.objects.filter(pk=1).update(
+            precompiled='0' + template.precompiled)
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertEqual(self.render(template),
+                         ("Test 1 Subject *HELLO*", "Test 1 body *WORLD*"))
+        self.assertEqual(self.events, [(0, 1), (0, 1)])
+
+    def test_signature(self):
+        """Ensure tampered templates are not loaded"""
+        template = EmailMessageTemplate.objects.get(pk=1)
+        with self.settings(SECRET_KEY='another key'):
+            self.assertEqual(template._load_precompiled(
+                    'subject_template', template.subject_template), None)
+
+    def test_unsaved_change(self):
+        """Ensure templates compiled from other sources are not used"""
+        template = EmailMessageTemplate.objects.get(pk=1)
+        template.subject_template = "Unsaved {{hello}}"
+        self.assertEqual(self.render(template)[0], "Unsaved *HELLO*")
+        self.assertTrue((0, 1) in self.events)
+
+    def test_constant_include(self):
+        """Ensure templates with constant includes are not stored"""
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        include = os.path.join(template_dir, 'inc.html')
+        with open(include, 'w') as f:
+            f.write("OLD include")
+        template = EmailMessageTemplate.objects.get(pk=1)
+        template.subject_template = '{% include "inc.html" %}'
+        with self.settings(EMAILTEMPLATES_PRECOMPILE_TEMPLATES=True,
+                           TEMPLATE_DIRS=(template_dir,)):
+            template.save()
+            self.assertTrue(template.precompiled)
+            with open(include, 'w') as f:
+                f.write("NEW include")
+            compiled_templates.clear()
+            validated_templates.clear()
+            template = EmailMessageTemplate.objects.get_template("Template 1")
+            self.assertEqual(self.render(template)[0], "NEW include")
+        self.assertEqual(sorted(self.events), [(0, 1), (1, 0)])
+
+    def test_custom_tag(self):
+        """Ensure templates with nodes from other libraries are not stored"""
+        builtins.append(shout_library)
+        self.addCleanup(builtins.remove, shout_library)
+        template = EmailMessageTemplate.objects.get(pk=1)
+        template.subject_template = "{% shout %} {{hello}}"
+        with self.settings(EMAILTEMPLATES_PRECOMPILE_TEMPLATES=True):
+            template.save()
+        compiled_templates.clear()
+        validated_templates.clear()
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertEqual(self.render(template)[0], "SHOUT *HELLO*")
+        self.assertEqual(sorted(self.events), [(0, 1), (1, 0)])
+
+    def test_disabled(self):
+        """Ensure nothing is stored unless the setting is enabled"""
+        template = EmailMessageTemplate.objects.get(pk=1)
+        self.assertTrue(template.precompiled)
+        template.save()
+        self.assertEqual(template.precompiled, '')
@@ -0,0 +1,241 @@
+"""
+Export and import of templates as JSON Lines, one template per line
+
+Each line is a JSON object holding a template's fields, with its related
+object type given as an [app label, model] pair (or null), so files can be
+moved between databases whose content type ids differ.  Templates are
+identified by name, related object type and related object id.
+"""
+import json
+from itertools import islice
+from multiprocessing import Pool
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.template import Template, TemplateSyntaxError
+from django.utils import timezone
+
+from models import EmailMessageTemplate
+from cache import compiled_templates, template_registry, bump_shared_version
+from rendering import context_paths
+
+#Fields written to and read from each line, besides content_type.  The first
+#two, with content_type, identify the template.
+FIELDS = ('name', 'object_id', 'type', 'subject_template', 'body_template',
+          'body_template_html', 'autogenerate_text', 'sender', 'base_cc',
+          'base_bcc', 'description', 'enabled')
+
+
+class TemplateImportError(Exception):
+    """
+    Raised when templates can't be imported, with a message for each problem, 
+    in line order
+    """
+
+    def __init__(self, errors):
+        self.errors = [u"Line {0}: {1}".format(line_number, message)
+                       for line_number, message in sorted(errors)]
+        super(TemplateImportError, self).__init__("\n".join(self.errors))
+
+
+def export_templates(out, queryset=None):
+    """
+    Write templates (all of them, or those in queryset) to a file-like object
+    as JSON Lines, and return the number written.
+    """
+    if queryset is None:
+        queryset = EmailMessageTemplate.objects.all()
+    content_types = dict((ct.pk, [ct.app_label, ct.model])
+                         for ct in ContentType.objects.all())
+    count = 0
+    for values in queryset.order_by('pk').values('content_type', *FIELDS)\
+            .iterator():
+        values['content_type'] = content_types.get(values['content_type'])
+        for field in ('base_cc', 'base_bcc'):
+            values[field] = EmailMessageTemplate._meta.get_field(field)\
+                .to_python(values[field]) or []
+        out.write(json.dumps(values, sort_keys=True) + "\n")
+        count += 1
+    return count
+
+
+def import_templates(lines, batch_size=500, workers=0, validate=True):
+    """
+    Create or update templates from an iterable of JSON Lines, and return a
+    (created, updated, unchanged) tuple of counts.
+
+    Lines are processed in batches of batch_size: the templates in a batch
+    are validated (compiled, in a pool of worker processes if workers is
+    set), matched against existing templates with one query, and written
+    with one bulk insert and an update for each changed template.  The whole
+    import happens in one transaction, and TemplateImportError is raised,
+    without changing anything, if any line is invalid.
+    """
+    content_types = dict(((ct.app_label, ct.model), ct.pk)
+                         for ct in ContentType.objects.all())
+    pool = Pool(workers) if workers else None
+    counts = [0, 0, 0]
+    errors = []
+    try:
+        with _atomic():
+            line_number = 0
+            iterator = iter(lines)
+            while True:
+                batch = []
+                for line in islice(iterator, batch_size):
+                    line_number += 1
+                    if line.strip():
+                        batch.append((line_number, line))
+                if not batch:
+                    break
+                templates = _parse(batch, content_types, errors)
+                if validate:
+                    _validate(templates, pool, errors)
+                if errors:
+                    raise TemplateImportError(errors)
+                for i, count in enumerate(_save(templates)):
+                    counts[i] += count
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    template_registry.clear()
+    compiled_templates.clear()
+    bump_shared_version()
+    return tuple(counts)
+
+
+def _atomic():
+    atomic = getattr(transaction, 'atomic', None)
+    if atomic is None:
+        return transaction.commit_on_success()
+    return atomic()
+
+
+def _parse(batch, content_types, errors):
+    """
+    Return a list of (line number, unsaved template) pairs for a batch of
+    lines.
+    """
+    templates = []
+    for line_number, line in batch:
+        try:
+            values = json.loads(line)
+            if not isinstance(values, dict):
+                raise ValueError("not a JSON object")
+            content_type = values.pop('content_type', None)
+            if content_type:
+                if not (isinstance(content_type, list) and
+                        len(content_type) == 2 and
+                        all(isinstance(part, basestring)
+                            for part in content_type)):
+                    raise ValueError("content_type must be a list of an app "
+                                     "label and a model name")
+                if tuple(content_type) not in content_types:
+                    raise ValueError(u"unknown content type {0}".format(
+                            u".".join(content_type)))
+                values['content_type_id'] = content_types[tuple(content_type)]
+            unknown = set(values) - set(FIELDS) - set(['content_type_id'])
+            if unknown:
+                raise ValueError("unknown fields " + ", ".join(sorted(unknown)))
+            templates.append((line_number, EmailMessageTemplate(**values)))
+        except (ValueError, TypeError) as e:
+            errors.append((line_number, unicode(e)))
+    return templates
+
+
+def _validate(templates, pool, errors):
+    """
+    Compile the template fields of each template, recording any syntax errors 
+    and building its variable index.
+    """
+    sources = [[getattr(template, field) or ''
+                for field in EmailMessageTemplate.TEMPLATE_FIELDS]
+               for line_number, template in templates]
+    if pool is not None:
+        results = pool.map(_compile, sources)
+    else:
+        results = [_compile(s) for s in sources]
+    for (line_number, template), (messages, index) in zip(templates, results):
+        for message in messages:
+            errors.append((line_number, message))
+        if not messages:
+            template.update_variable_index(index)
+
+
+def _compile(sources):
+    """
+    Compile the sources of a template's fields, and return a list of syntax 
+    error messages and the variable index for the fields.  Run in worker 
+    processes, so it only returns picklable results.
+    """
+    messages = []
+    index = {}
+    for field, source in zip(EmailMessageTemplate.TEMPLATE_FIELDS, sources):
+        try:
+            template = Template(source)
+        except TemplateSyntaxError as e:
+            messages.append(u"{0}: Invalid Template Syntax: {1}".format(
+                    field, e))
+        else:
+            index[field] = sorted(context_paths(template.nodelist))
+    return messages, index
+
+
+def _save(templates):
+    """
+    Insert new templates and update changed ones, and return (created,
+    updated, unchanged) counts.
+    """
+    manager = EmailMessageTemplate.objects
+    attnames = ['content_type_id'] + list(FIELDS)
+    names = set(template.name for line_number, template in templates)
+    existing = {}
+    for row in manager.filter(name__in=names).values_list('pk', *attnames):
+        values = _comparable(dict(zip(attnames, row[1:])))
+        existing[_key(values)] = (row[0], values)
+
+    created = {}
+    updated = unchanged = 0
+    now = timezone.now()
+    for line_number, template in templates:
+        values = _comparable(dict((attname, getattr(template, attname))
+                                  for attname in attnames))
+        key = _key(values)
+        if not template.variable_index:
+            template.update_variable_index()
+        template.update_precompiled()
+        if key not in existing:
+            #If a template is repeated, the last line wins
+            template.edited_date = now
+            created[key] = template
+            continue
+        pk, current = existing[key]
+        if current == values:
+            unchanged += 1
+            continue
+        fields = dict((attname, getattr(template, attname))
+                      for attname in FIELDS[2:])
+        manager.filter(pk=pk).update(variable_index=template.variable_index,
+                                     precompiled=template.precompiled,
+                                     edited_date=now, **fields)
+        existing[key] = (pk, values)
+        updated += 1
+    manager.bulk_create(created.values())
+    return len(created), updated, unchanged
+
+
+def _key(values):
+    return (values['name'], values['content_type_id'], values['object_id'])
+
+
+def _comparable(values):
+    """
+    Convert address lists in a dictionary of field values to their stored
+    form, so that values from a file and the database can be compared.
+    """
+    for name in ('base_cc', 'base_bcc'):
+        field = EmailMessageTemplate._meta.get_field(name)
+        values[name] = field.get_prep_value(field.to_python(values[name]))
+    return values
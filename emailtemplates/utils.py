@@ -1,14 +1,18 @@
-import copy
+from itertools import islice
 
-from django.core.mail import get_connection
 from django.conf import settings
 
-from models import EmailMessageTemplate
+from models import EmailMessageTemplate, TemplatedMessage
+from connections import pooled_connection
+from mailqueue import enqueue
+from background import run_in_background
+from rendering import RenderPool, render_context, segment_templates
+from signals import timed
 
 
 def send_mail(name, related_object=None, context={}, from_email=None,
               recipient_list=[], fail_silently=False, auth_user=None,
-               auth_password=None, connection=None):
+              auth_password=None, connection=None, queue=False):
     """
     Easy wrapper for sending a single templated message to a recipient list.  
     The template to use is retrieved from the database based on the name and 
@@ -19,24 +23,59 @@ def send_mail(name, related_object=None, context={}, from_email=None,
 
     If auth_user is None, the EMAIL_HOST_USER setting is used.
     If auth_password is None, the EMAIL_HOST_PASSWORD setting is used.
+
+    If no connection is given, one is taken from the shared connection pool 
+    (see EMAILTEMPLATES_CONNECTION_POOL_SIZE) and returned to it afterwards.
+
+    If queue is set, the message is stored in the database and sent later by 
+    the run_emailtemplates_worker command, using the default connection 
+    settings, and the QueuedMessage is returned.  The context must then be 
+    JSON serializable.
     """
 
     template = EmailMessageTemplate.objects.get_template(name, related_object)
+    if queue:
+        if auth_user or auth_password or connection:
+            raise ValueError("Queued messages are sent with the worker's "
+                             "connection settings")
+        return enqueue(template, context, from_email, recipient_list)
+    return _send_template(template, context, from_email, recipient_list,
+                          fail_silently, auth_user, auth_password, connection)
+
+
+def send_mail_async(name, related_object=None, context={}, from_email=None,
+                    recipient_list=[], fail_silently=False, auth_user=None,
+                    auth_password=None, connection=None):
+    """
+    Non-blocking version of send_mail.  The template (with its deferred 
+    sources) is retrieved in the calling thread (Django database connections 
+    are per thread), and the message is rendered and delivered in the 
+    background send pool.  Returns an AsyncResult, whose get() method waits 
+    for and returns the result of sending, or raises its exception.
+    """
+    template = EmailMessageTemplate.objects.get_template(name, related_object)
+    template.load_template_sources()
+    return run_in_background(_send_template, template, context, from_email,
+                             recipient_list, fail_silently, auth_user,
+                             auth_password, connection)
 
-    connection = connection or get_connection(username=auth_user,
-                                              password=auth_password,
-                                              fail_silently=fail_silently)
 
-    template.context=context
-    template.from_email=from_email
-    template.to=recipient_list
-    template.connection=connection
+def _send_template(template, context, from_email, recipient_list,
+                   fail_silently, auth_user, auth_password, connection):
+    with pooled_connection(connection, auth_user, auth_password,
+                           fail_silently) as connection:
+        template.context=context
+        template.from_email=from_email
+        template.to=recipient_list
+        template.connection=connection
 
-    return template.send()
+        return template.send()
 
 
 def send_mass_mail(name, related_object=None, datatuple=(), fail_silently=False,
-                   auth_user=None, auth_password=None, connection=None):
+                   auth_user=None, auth_password=None, connection=None,
+                   chunk_size=None, workers=None, pool=None,
+                   recipient_keys=None, attachments=()):
     """
     Given a datatuple of (context, from_email, recipient_list), renders and 
     sends a message to each recipient list. Returns the number of emails sent.
@@ -51,24 +90,126 @@ def send_mass_mail(name, related_object=None, datatuple=(), fail_silently=False,
     retrieve a template with the specified name without a related object instead
     (to support situations where some objects have a specialized template, but, 
     when none exists, we want to fall back to a default). 
-    """
 
-    template = EmailMessageTemplate.objects.get_template(name, related_object)
+    The datatuple may be any iterable, and messages are rendered and sent in 
+    chunks of chunk_size (EMAILTEMPLATES_MASS_MAIL_CHUNK_SIZE by default), so 
+    memory use does not grow with the number of messages.
+
+    If workers (EMAILTEMPLATES_RENDER_WORKERS by default) is set, messages are 
+    rendered in a pool of that many worker processes, or threads if pool is 
+    'thread', while earlier chunks are being sent.  Messages are still 
+    delivered in datatuple order.
+
+    If recipient_keys lists the context keys that differ between recipients, 
+    the parts of each template that don't use them are rendered only once, 
+    against the first context.  All other context values must then be the 
+    same for every message.
 
-    connection = connection or get_connection(username=auth_user,
-                                              password=auth_password,
-                                              fail_silently=fail_silently)
+    attachments may list files (as MIMEBase objects or (filename, content, 
+    mimetype) tuples) to attach to every message.  These and any attachments 
+    on the template are encoded once and shared by all the messages.
+    """
+    return sum(iter_send_mass_mail(name, related_object, datatuple,
+                                   fail_silently=fail_silently,
+                                   auth_user=auth_user,
+                                   auth_password=auth_password,
+                                   connection=connection,
+                                   chunk_size=chunk_size, workers=workers,
+                                   pool=pool, recipient_keys=recipient_keys,
+                                   attachments=attachments))
+
+
+def iter_send_mass_mail(name, related_object=None, datatuple=(),
+                        fail_silently=False, auth_user=None,
+                        auth_password=None, connection=None, chunk_size=None,
+                        workers=None, pool=None, recipient_keys=None,
+                        attachments=()):
+    """
+    Generator version of send_mass_mail.  Consumes the datatuple lazily (so a 
+    generator or queryset iterator can be used), renders and sends it in 
+    chunks over a single open connection, and yields the number of messages 
+    sent for each chunk.  Other arguments are as for send_mass_mail.
+    """
+    template = EmailMessageTemplate.objects.get_template(name, related_object)
+    return _iter_send_template(template, datatuple, fail_silently, auth_user,
+                               auth_password, connection, chunk_size, workers,
+                               pool, recipient_keys, attachments)
 
-    messages = []
-    for (context, from_email, recipient_list) in datatuple:
-        message = copy.deepcopy(template)
-        message.context=context
-        message.from_email=from_email
-        message.to=recipient_list
-        message.connection=connection
-        messages.append(message)
 
-    return connection.send_messages(messages)
+def send_mass_mail_async(name, related_object=None, datatuple=(),
+                         fail_silently=False, auth_user=None,
+                         auth_password=None, connection=None, chunk_size=None,
+                         workers=None, pool=None, recipient_keys=None,
+                         attachments=()):
+    """
+    Non-blocking version of send_mass_mail.  The template is retrieved in the 
+    calling thread, and the messages are rendered and delivered in the 
+    background send pool.  Returns an AsyncResult, whose get() method waits 
+    for and returns the number of messages sent.
+    """
+    template = EmailMessageTemplate.objects.get_template(name, related_object)
+    template.load_template_sources()
+    messages = _iter_send_template(template, datatuple, fail_silently,
+                                   auth_user, auth_password, connection,
+                                   chunk_size, workers, pool, recipient_keys,
+                                   attachments)
+    return run_in_background(sum, messages)
+
+
+def _iter_send_template(template, datatuple, fail_silently, auth_user,
+                        auth_password, connection, chunk_size, workers, pool,
+                        recipient_keys, attachments):
+    chunk_size = chunk_size or settings.EMAILTEMPLATES_MASS_MAIL_CHUNK_SIZE
+    attachments = template.encoded_attachments(attachments)
+    workers = workers or settings.EMAILTEMPLATES_RENDER_WORKERS
+
+    renderer = None
+    if workers:
+        renderer = RenderPool(template, workers,
+                              pool or settings.EMAILTEMPLATES_RENDER_POOL,
+                              recipient_keys)
+        chunks = renderer.render_chunks(_chunks(datatuple, chunk_size))
+    else:
+        templates = None
+        if recipient_keys:
+            templates = segment_templates(template, recipient_keys)
+        chunks = ((chunk, [render_context(template, entry[0], templates)
+                           for entry in chunk])
+                  for chunk in _chunks(datatuple, chunk_size))
+
+    try:
+        with pooled_connection(connection, auth_user, auth_password,
+                               fail_silently) as connection:
+            new_connection = connection.open()
+            try:
+                for chunk, rendered in chunks:
+                    messages = [TemplatedMessage(template, context, from_email,
+                                                 recipient_list, connection, r,
+                                                 attachments)
+                                for ((context, from_email, recipient_list), r)
+                                in zip(chunk, rendered)]
+                    with timed('send', template.name):
+                        sent = connection.send_messages(messages)
+                    yield sent or 0
+            finally:
+                if new_connection:
+                    connection.close()
+    finally:
+        if renderer is not None:
+            renderer.close()
+
+
+def _chunks(iterable, size):
+    """
+    Split an iterable into lists of at most size items without consuming more 
+    of it than necessary.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def mail_admins(name, related_object=None, context={}, fail_silently=False,
@@ -13,7 +13,12 @@ setup(
     author_email='michael@mcoconnor.net',
     url='https://github.com/DariaKnyazeva/django-emailtemplates.git',
     license='MIT',
-    packages=['emailtemplates'],
+    packages=[
+        'emailtemplates',
+        'emailtemplates.management',
+        'emailtemplates.management.commands',
+        'emailtemplates.migrations',
+    ],
     install_requires=[
         'django-appconf',
     ],